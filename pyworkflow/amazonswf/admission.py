@@ -0,0 +1,35 @@
+class Admission(object):
+    # Decides whether to take on one more task ahead of time. Tasks are handled width at a time,
+    # and one taken now has to wait for the ones that are waiting before it's handled. It's only
+    # taken while it would still be handled before it times out, going by a moving average of
+    # how long handling takes and the shortest timeout that tasks had.
+
+    # weight of the latest task in the moving average
+    DURATION_WEIGHT = 0.2
+
+    def __init__(self, width=1):
+        self.width = width
+        self.duration = None
+        self.timeout = None
+
+    def deadline(self, received, timeout):
+        # when a task that was received at received times out, if it does
+        if timeout is None:
+            return None
+        self.timeout = timeout if self.timeout is None else min(self.timeout, timeout)
+        return received + timeout
+
+    def finished(self, duration):
+        self.duration = duration if self.duration is None else self.duration + self.DURATION_WEIGHT * (duration - self.duration)
+
+    def admits(self, running, waiting):
+        # a task is always taken while it can be handled right away. until it's known how long
+        # handling takes, only one is taken ahead.
+        if running + waiting < self.width:
+            return True
+        if self.duration is None or self.timeout is None:
+            return not waiting
+
+        # when all are busy, one has to finish before the waiting ones move up
+        rounds = (waiting + (1 if running >= self.width else 0)) / float(self.width)
+        return (rounds + 1) * self.duration < self.timeout
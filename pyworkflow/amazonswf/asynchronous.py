@@ -0,0 +1,68 @@
+from multiprocessing.pool import ThreadPool
+
+class AsyncAmazonSWFBackend(object):
+    # Asynchronous counterpart of an AmazonSWFBackend. Calls run on bounded pools of threads
+    # over the backend's pooled connections, and return an AsyncResult right away. Each call
+    # also takes an optional callback, which is called with the result. Long polls run on
+    # their own pool of poll_size threads, so they can't hold up other calls.
+    #
+    # boto's connections block, so every outstanding long poll still takes up a thread for as
+    # long as it's open (up to a minute). At most poll_size polls are open at a time, further
+    # ones wait in the pool's queue. Idle polls aren't free the way they'd be on an event loop.
+
+    def __init__(self, backend, size=20, poll_size=10):
+        self.backend = backend
+        self._pool = ThreadPool(size)
+        self._poll_pool = ThreadPool(poll_size)
+
+    def _call(self, fn, args, kwargs, pool=None):
+        callback = kwargs.pop('callback', None)
+        return (pool or self._pool).apply_async(fn, args, kwargs, callback=callback)
+
+    def poll_activity_task(self, *args, **kwargs):
+        return self._call(self.backend.poll_activity_task, args, kwargs, self._poll_pool)
+
+    def poll_decision_task(self, *args, **kwargs):
+        return self._call(self.backend.poll_decision_task, args, kwargs, self._poll_pool)
+
+    def complete_activity_task(self, *args, **kwargs):
+        return self._call(self.backend.complete_activity_task, args, kwargs)
+
+    def complete_decision_task(self, *args, **kwargs):
+        return self._call(self.backend.complete_decision_task, args, kwargs)
+
+    def heartbeat_activity_task(self, *args, **kwargs):
+        return self._call(self.backend.heartbeat_activity_task, args, kwargs)
+
+    def start_process(self, *args, **kwargs):
+        return self._call(self.backend.start_process, args, kwargs)
+
+    def signal_process(self, *args, **kwargs):
+        return self._call(self.backend.signal_process, args, kwargs)
+
+    def cancel_process(self, *args, **kwargs):
+        return self._call(self.backend.cancel_process, args, kwargs)
+
+    def process_by_id(self, *args, **kwargs):
+        return self._call(self.backend.process_by_id, args, kwargs)
+
+    def process_history(self, *args, **kwargs):
+        return self._call(self.backend.process_history, args, kwargs)
+
+    def history_pages(self, process_id, reverse_order=False):
+        # iterates over the pages of a history, fetching each one on the pool while the page
+        # before it is consumed
+        pages = self.backend.history_pages(process_id, reverse_order=reverse_order)
+        pending = self._pool.apply_async(next, (pages, None))
+        while True:
+            page = pending.get()
+            if page is None:
+                return
+
+            pending = self._pool.apply_async(next, (pages, None))
+            yield page
+
+    def close(self):
+        for pool in [self._poll_pool, self._pool]:
+            pool.close()
+            pool.join()
@@ -2,35 +2,77 @@ __version__ = '0.1.0'
 __author__ = 'Willem Bult'
 __email__ = 'willem.bult@gmail.com'
 
-import json
 import uuid
 import time
 import boto.swf
 import re
+import logging
 
 from boto.exception import SWFResponseError
 from datetime import datetime, timedelta
-from itertools import imap
+from itertools import imap, chain
+from collections import namedtuple
 
 from pyworkflow.backend import Backend
 from pyworkflow.exceptions import UnknownDecisionException, UnknownActivityException
 from pyworkflow.defaults import Defaults
 
-from process import AmazonSWFProcess, ActivityCompleted, ActivityFailed, ActivityCanceled
+from pyworkflow.decision import CompleteProcess, CancelProcess
+
+from process import AmazonSWFProcess, AmazonSWFHistory, AmazonSWFLazyHistory, unseen_events, ActivityCompleted, ActivityFailed, ActivityCanceled
 from task import decision_task_from_description, activity_task_from_description
 from decision import AmazonSWFDecision
+from cache import HistoryCache
+from codec import default_codec, CompressingCodec, OffloadingCodec
+from parallel import parallel_imap
+from registration import RegistrationCache
+from connection import PooledLayer1
+from throttle import RateLimiter, RetryPolicy
+from faults import fault_type
+from heartbeat import HeartbeatScheduler
+from pipeline import DecisionPipeline
+
+logger = logging.getLogger(__name__)
+
+# outcome of one item of a bulk call: either result or error is set
+BulkResult = namedtuple('BulkResult', ['item', 'result', 'error'])
 
 def uncamelcase(name):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
+# roughly what an event description takes up besides its string attributes
+EVENT_OVERHEAD = 200
+
+def approximate_size(events):
+    # bytes of the string attributes of event descriptions (inputs, results, details...), which
+    # is where their size lies, without encoding them again
+    size = 0
+    for event in events:
+        size += EVENT_OVERHEAD
+        for value in event.itervalues():
+            if isinstance(value, dict):
+                size += sum(len(v) for v in value.itervalues() if isinstance(v, basestring))
+    return size
+
 class AmazonSWFConfiguration(dict):
 
+    def __init__(self, *args, **kwargs):
+        super(AmazonSWFConfiguration, self).__init__(*args, **kwargs)
+        self._exports = {}
+
+    def _configure(self, key, conf):
+        self[key] = conf
+
+        # drop exports of any previous configuration, and prepare the one decisions are built from
+        self._exports = dict((k, v) for (k, v) in self._exports.items() if k[0] != key)
+        self._cached_export(key, True, '')
+
     def config_workflow(self, name, conf):
-        self['%sWorkflow' % name] = conf
+        self._configure('%sWorkflow' % name, conf)
 
     def config_activity(self, name, conf):
-        self['%sActivity' % name] = conf
+        self._configure('%sActivity' % name, conf)
 
     def _export(self, conf, camelcase=True, prepend=''):
         if prepend:
@@ -41,25 +83,91 @@ class AmazonSWFConfiguration(dict):
 
         return conf
 
+    def _cached_export(self, key, camelcase, prepend):
+        cache_key = (key, camelcase, prepend)
+        export = self._exports.get(cache_key, None)
+        if export is None:
+            export = self._exports[cache_key] = self._export(self[key], camelcase, prepend)
+        return export
+
     def for_workflow(self, name, camelcase=True, prepend=''):
-        return self._export(self['%sWorkflow' % name], camelcase, prepend)
+        return dict(self._cached_export('%sWorkflow' % name, camelcase, prepend))
 
     def for_activity(self, name, camelcase=True, prepend=''):
-        return self._export(self['%sActivity' % name], camelcase, prepend)
+        return dict(self._cached_export('%sActivity' % name, camelcase, prepend))
+
+    # templates are shared between decisions and must not be modified
+
+    def workflow_template(self, name):
+        return self._cached_export('%sWorkflow' % name, True, '')
+
+    def activity_template(self, name):
+        return self._cached_export('%sActivity' % name, True, '')
 
 
         
 class AmazonSWFBackend(Backend):
+
+    # SWF takes at most this many decisions in one response, and timer controls of at most this many bytes
+    MAX_DECISIONS = 100
+    MAX_CONTROL = 32768
     
     @staticmethod
     def _get_region(name):
         return next((region for region in boto.swf.regions() if region.name == name), None )
 
-    def __init__(self, access_key_id, secret_access_key, region='us-east-1', domain='default'):
+    def __init__(self, access_key_id, secret_access_key, region='us-east-1', domain='default', history_cache_size=0, lazy_history=False, fetch_width=8, codec=None, registration_cache=None, max_connections=10, max_polls=10, auto_heartbeat=False, heartbeat_fraction=0.5, rate_limits=None, max_retries=3, payload_store=None, offload_threshold=16 * 1024, compression_threshold=None, connection_factory=None, instrumentation=None, snapshot_store=None):
         self.domain = domain
-        self._swf = boto.swf.layer1.Layer1(access_key_id, secret_access_key, region=self._get_region(region))
+
+        # connections are pooled so a backend can be shared between threads. long polls
+        # get up to max_polls connections of their own, other calls up to max_connections.
+        # rate_limits maps Layer1 calls (or 'default') to the calls per second they start
+        # out with, and adapt from when SWF throttles. Throttled calls, and calls that only
+        # read and failed on SWF's side, are retried up to max_retries times.
+        # connection_factory makes Layer1 connections, or stand-ins such as a LocalSWF
+        region = self._get_region(region)
+        self._swf = PooledLayer1(
+            connection_factory or (lambda: boto.swf.layer1.Layer1(access_key_id, secret_access_key, region=region)),
+            size=max_connections, poll_size=max_polls,
+            limiter=RateLimiter(rate_limits) if rate_limits else None,
+            retry=RetryPolicy(max_retries) if max_retries else None,
+            instrumentation=instrumentation)
+
+        # optional Instrumentation that measurements of calls, polls and parsing are reported to
+        self._instrumentation = instrumentation
+
         self._config = AmazonSWFConfiguration()
 
+        # encodes and decodes inputs, results and other payloads. with a compression_threshold,
+        # payloads larger than that many bytes are compressed. with a payload_store, payloads
+        # (compressed) larger than offload_threshold bytes are kept there, and SWF only sees a reference
+        self._codec = codec or default_codec
+        if compression_threshold is not None:
+            self._codec = CompressingCodec(self._codec, compression_threshold)
+        if payload_store is not None:
+            self._codec = OffloadingCodec(payload_store, self._codec, offload_threshold)
+
+        # types known to be registered, optionally shared through a file at registration_cache
+        self._registered = RegistrationCache(domain, registration_cache)
+
+        # opt-in cache of parsed decision task histories, so repeated decision tasks
+        # for the same run only need to parse events that were added since
+        self._history_cache = HistoryCache(history_cache_size) if history_cache_size else None
+
+        # page through history newest to oldest, and only once the process history is read
+        self._lazy_history = lazy_history
+
+        # optional SnapshotStore that keeps the events of runs on disk, so that only events that
+        # are new to it are fetched, also after restarts and across worker processes
+        self._snapshots = snapshot_store
+
+        # number of execution histories processes() fetches concurrently
+        self._fetch_width = fetch_width
+
+        # with auto_heartbeat, polled activity tasks are heartbeated in the background at
+        # heartbeat_fraction of their heartbeat timeout, until they're completed
+        self._heartbeats = HeartbeatScheduler(self._send_heartbeat, heartbeat_fraction) if auto_heartbeat else None
+
     def _consume_until_exhaustion(self, request_fn):
         next_page_token = None
         while True:
@@ -70,7 +178,7 @@ class AmazonSWFBackend(Backend):
             if not next_page_token:
                 break
     
-    def register_workflow(self, name, category=Defaults.DECISION_CATEGORY,
+    def _configure_workflow(self, name, category=Defaults.DECISION_CATEGORY,
         timeout=Defaults.WORKFLOW_TIMEOUT, decision_timeout=Defaults.DECISION_TIMEOUT):
 
         self._config.config_workflow(name, {
@@ -80,15 +188,7 @@ class AmazonSWFBackend(Backend):
             'taskStartToCloseTimeout': str(decision_timeout)
         })
 
-        try:
-            self._swf.describe_workflow_type(self.domain, name, "1.0")
-        except:
-            # Workflow type not registered yet
-            config = self._config.for_workflow(name, camelcase=False, prepend='default')
-            del config['default_task_list'] # don't need this in there
-            self._swf.register_workflow_type(self.domain, name, "1.0", task_list=category, **config)
-
-    def register_activity(self, name, category=Defaults.ACTIVITY_CATEGORY, 
+    def _configure_activity(self, name, category=Defaults.ACTIVITY_CATEGORY, 
         scheduled_timeout=Defaults.ACTIVITY_SCHEDULED_TIMEOUT, 
         execution_timeout=Defaults.ACTIVITY_EXECUTION_TIMEOUT, 
         heartbeat_timeout=Defaults.ACTIVITY_HEARTBEAT_TIMEOUT):
@@ -101,12 +201,83 @@ class AmazonSWFBackend(Backend):
             'startToCloseTimeout': str(execution_timeout)
         })
 
+    def _register_type(self, kind, name):
+        try:
+            if kind == 'workflow':
+                config = self._config.for_workflow(name, camelcase=False, prepend='default')
+                task_list = config.pop('default_task_list')['name']
+                self._swf.register_workflow_type(self.domain, name, "1.0", task_list=task_list, **config)
+            else:
+                config = self._config.for_activity(name, camelcase=False, prepend='defaultTask')
+                task_list = config.pop('default_task_task_list')['name']
+                self._swf.register_activity_type(self.domain, name, "1.0", task_list=task_list, **config)
+        except SWFResponseError, e:
+            # fine if someone else registered it in the meantime
+            if fault_type(e) != 'TypeAlreadyExistsFault':
+                raise e
+
+        self._registered.add(kind, name)
+
+    def _ensure_registered(self, kind, name):
+        if (kind, name) in self._registered:
+            return
+
+        describe_type = self._swf.describe_workflow_type if kind == 'workflow' else self._swf.describe_activity_type
         try:
-            self._swf.describe_activity_type(self.domain, name, "1.0")
-        except:
-            config = self._config.for_activity(name, camelcase=False, prepend='defaultTask')
-            del config['default_task_task_list'] # don't need this in there
-            self._swf.register_activity_type(self.domain, name, "1.0", task_list=category, **config)
+            describe_type(self.domain, name, "1.0")
+            self._registered.add(kind, name)
+        except SWFResponseError, e:
+            if fault_type(e) != 'UnknownResourceFault':
+                raise e
+            # type not registered yet
+            self._register_type(kind, name)
+
+        self._registered.save()
+
+    def register_workflow(self, name, category=Defaults.DECISION_CATEGORY,
+        timeout=Defaults.WORKFLOW_TIMEOUT, decision_timeout=Defaults.DECISION_TIMEOUT):
+
+        self._configure_workflow(name, category, timeout, decision_timeout)
+        self._ensure_registered('workflow', name)
+
+    def register_activity(self, name, category=Defaults.ACTIVITY_CATEGORY, 
+        scheduled_timeout=Defaults.ACTIVITY_SCHEDULED_TIMEOUT, 
+        execution_timeout=Defaults.ACTIVITY_EXECUTION_TIMEOUT, 
+        heartbeat_timeout=Defaults.ACTIVITY_HEARTBEAT_TIMEOUT):
+
+        self._configure_activity(name, category, scheduled_timeout, execution_timeout, heartbeat_timeout)
+        self._ensure_registered('activity', name)
+
+    def _registered_types(self, kind):
+        list_types = self._swf.list_workflow_types if kind == 'workflow' else self._swf.list_activity_types
+        response_iter = self._consume_until_exhaustion(
+            lambda token: list_types(self.domain, 'REGISTERED', next_page_token=token)
+        )
+
+        type_key = '%sType' % kind
+        return [info[type_key]['name'] for response in response_iter for info in response.get('typeInfos', []) if info[type_key]['version'] == "1.0"]
+
+    def register_all(self, workflows={}, activities={}, width=8):
+        # workflows and activities map names to the keyword arguments of register_workflow and
+        # register_activity. Types that aren't registered yet are found with a single listing
+        # per kind, and registered concurrently.
+        for (name, kwargs) in workflows.items():
+            self._configure_workflow(name, **kwargs)
+        for (name, kwargs) in activities.items():
+            self._configure_activity(name, **kwargs)
+
+        wanted = [('workflow', name) for name in workflows] + [('activity', name) for name in activities]
+        missing = [key for key in wanted if key not in self._registered]
+
+        for kind in set(kind for (kind, name) in missing):
+            for name in self._registered_types(kind):
+                self._registered.add(kind, name)
+
+        missing = [key for key in missing if key not in self._registered]
+        for _ in parallel_imap(lambda (kind, name): self._register_type(kind, name), missing, width=width):
+            pass
+
+        self._registered.save()
     
     def start_process(self, process):
         if process.id is not None:
@@ -127,7 +298,7 @@ class AmazonSWFBackend(Backend):
         workflow_id = str(uuid.uuid4())
         ret = self._swf.start_workflow_execution(
             self.domain, workflow_id, process.workflow, "1.0",
-            input=json.dumps(process.input),
+            input=self._codec.encode(process.input),
             tag_list=process.tags,
             **config)
 
@@ -138,7 +309,7 @@ class AmazonSWFBackend(Backend):
         pid = process_or_id.id if hasattr(process_or_id, 'id') else process_or_id
         self._swf.signal_workflow_execution(
             self.domain, signal, pid.split(':')[0],
-            input=json.dumps(data))
+            input=self._codec.encode(data))
 
     def cancel_process(self, process_or_id, details=None):
         pid = process_or_id.id if hasattr(process_or_id, 'id') else process_or_id
@@ -146,28 +317,151 @@ class AmazonSWFBackend(Backend):
             self.domain, pid.split(':')[0], 
             details=details)
 
-    def heartbeat_activity_task(self, task):
-        self._swf.record_activity_task_heartbeat(task.context['token'])
+    def _bulk(self, fn, items, width):
+        def call(item):
+            try:
+                return BulkResult(item, fn(item), None)
+            except Exception, e:
+                return BulkResult(item, None, e)
+
+        # calls run concurrently, and go through the same rate limits as any other call
+        return list(parallel_imap(call, items, width=width))
+
+    def start_processes(self, processes, width=8):
+        return self._bulk(self.start_process, processes, width)
+
+    def signal_processes(self, signals, width=8):
+        # signals are (process_or_id, signal, data) tuples
+        return self._bulk(lambda (process_or_id, signal, data): self.signal_process(process_or_id, signal, data), signals, width)
+
+    def cancel_processes(self, processes_or_ids, details=None, width=8):
+        return self._bulk(lambda process_or_id: self.cancel_process(process_or_id, details=details), processes_or_ids, width)
+
+    def _send_heartbeat(self, token, details=None):
+        try:
+            return self._swf.record_activity_task_heartbeat(token, details=details)
+        except SWFResponseError, e:
+            if fault_type(e) == 'UnknownResourceFault':
+                # task timed out or was completed elsewhere
+                self._heartbeats.untrack(token)
+                return None
+            raise e
+
+    @property
+    def instrumentation(self):
+        # what measurements are reported to, if anything
+        return self._instrumentation
+
+    def heartbeat_timeout(self, activity):
+        # seconds an activity task has between heartbeats, if it has to heartbeat
+        try:
+            timeout = self._config.activity_template(activity)['heartbeatTimeout']
+        except KeyError:
+            timeout = Defaults.ACTIVITY_HEARTBEAT_TIMEOUT
+        return None if str(timeout) == 'NONE' else float(timeout)
+
+    def activity_timeout(self, activity):
+        # seconds an activity task has at most from being started until it times out
+        try:
+            template = self._config.activity_template(activity)
+            timeouts = [template['startToCloseTimeout'], template['scheduleToCloseTimeout']]
+        except KeyError:
+            timeouts = [Defaults.ACTIVITY_EXECUTION_TIMEOUT]
+        timeouts = [float(timeout) for timeout in timeouts if str(timeout) != 'NONE']
+        return min(timeouts) if timeouts else None
+
+    def decision_timeout(self, workflow):
+        # seconds a decision task has from being handed out until it times out
+        try:
+            timeout = self._config.workflow_template(workflow)['taskStartToCloseTimeout']
+        except KeyError:
+            timeout = Defaults.DECISION_TIMEOUT
+        return None if str(timeout) == 'NONE' else float(timeout)
+
+    def heartbeat_activity_task(self, task, details=None):
+        token = task.context['token']
+
+        # tasks that are heartbeated in the background have this coalesced into their next heartbeat
+        if self._heartbeats is None or not self._heartbeats.beat(token, details):
+            response = self._swf.record_activity_task_heartbeat(token, details=details)
+            task.context['cancel_requested'] = bool(response and response.get('cancelRequested', False))
+
+        return self.cancel_requested(task)
+
+    def stop_heartbeats(self):
+        # sends pending heartbeats, and stops the background thread until a task is tracked again
+        if self._heartbeats is not None:
+            self._heartbeats.stop()
+
+    def close(self):
+        self.stop_heartbeats()
+        self._swf.close()
+
+    def cancel_requested(self, task):
+        if task.context.get('cancel_requested', False):
+            return True
+        return self._heartbeats is not None and self._heartbeats.cancel_requested(task.context['token'])
+
+    def _pending_descriptions(self, task):
+        # decisions that didn't fit previous responses, carried by continuation timers that fired since
+        history = task.context.get('history', None)
+        controls = history.continuations if history is not None else []
+        return [description for control in controls if control for description in self._codec.decode(control)]
+
+    def _controls(self, descriptions):
+        # splits descriptions into encoded lists that each fit a timer control
+        chunks = [[]]
+        size = 2
+        for description in descriptions:
+            length = len(default_codec.encode(description)) + 2
+            if chunks[-1] and size + length > self.MAX_CONTROL:
+                chunks.append([])
+                size = 2
+            chunks[-1].append(description)
+            size += length
+        return [self._codec.encode(chunk) for chunk in chunks if chunk]
+
+    def _split(self, descriptions):
+        # when there are more descriptions than SWF takes at once, those that don't fit are put in
+        # the controls of timers that fire right away. the decision task that follows sends them.
+        if len(descriptions) <= self.MAX_DECISIONS:
+            return descriptions
+
+        timers = 1
+        while timers < self.MAX_DECISIONS:
+            sent, rest = descriptions[:self.MAX_DECISIONS - timers], descriptions[self.MAX_DECISIONS - timers:]
+            controls = self._controls(rest)
+            if len(controls) <= timers:
+                return sent + [AmazonSWFDecision.continuation_timer_description(control) for control in controls]
+            timers = len(controls)
+
+        raise ValueError('Too many decisions to carry over to the next decision task')
 
     def complete_decision_task(self, task, decisions):
         if not type(decisions) is list:
             decisions = [decisions]
-        descriptions = [AmazonSWFDecision(d, self._config).description for d in decisions]
+        descriptions = self._split(self._pending_descriptions(task) + AmazonSWFDecision.descriptions(decisions, self._config, self._codec))
+
+        if self._history_cache is not None and any(isinstance(d, (CompleteProcess, CancelProcess)) for d in decisions):
+            self._history_cache.evict(task.process.id)
 
         try:
             self._swf.respond_decision_task_completed(task.context['token'], 
                 decisions=descriptions,
                 execution_context=None)
         except SWFResponseError, e:
-            if e.body.get('__type', None) == 'com.amazonaws.swf.base.model#UnknownResourceFault':
+            if fault_type(e) == 'UnknownResourceFault':
                 raise UnknownDecisionException()
             else:
                 raise e
 
     def complete_activity_task(self, task, result=None):
+        if self._heartbeats is not None:
+            self._heartbeats.untrack(task.context['token'])
+
         try:
             if isinstance(result, ActivityCompleted):
-                self._swf.respond_activity_task_completed(task.context['token'], result=json.dumps(result.result))
+                self._swf.respond_activity_task_completed(task.context['token'], result=self._codec.encode(result.result))
             elif isinstance(result, ActivityCanceled):
                 self._swf.respond_activity_task_canceled(task.context['token'], details=result.details)
             elif isinstance(result, ActivityFailed):
@@ -175,60 +469,252 @@ class AmazonSWFBackend(Backend):
             else:
                 raise ValueError('Expected result of type in [ActivityCompleted, ActivityCanceled, ActivityFailed]')
         except SWFResponseError, e:
-            if e.body.get('__type', None) == 'com.amazonaws.swf.base.model#UnknownResourceFault':
+            if fault_type(e) == 'UnknownResourceFault':
                 raise UnknownActivityException()
             else:
                 raise e
 
-    def _workflow_execution_history(self, description):
+    def _instrumented_pages(self, name, response_iter):
+        # reports pages, events and bytes per history once it's done with. bytes are
+        # estimated from the events, so only approximate what came over the wire.
+        pages = events = size = 0
+        try:
+            for response in response_iter:
+                pages += 1
+                events += len(response.get('events', []))
+                size += approximate_size(response.get('events', []))
+                yield response
+        finally:
+            if events:
+                self._instrumentation.observe('%s.pages' % name, pages)
+                self._instrumentation.observe('%s.events' % name, events)
+                self._instrumentation.observe('%s.bytes' % name, size)
+
+    def _workflow_execution_pages(self, description, reverse_order=None):
         run_id = description['execution']['runId']
         workflow_id = description['execution']['workflowId']
 
-        # exhaustively query execution history using next_page_token
+        # pages are only requested as they are consumed
         response_iter = self._consume_until_exhaustion(
-            lambda token: self._swf.get_workflow_execution_history(self.domain, run_id, workflow_id, next_page_token=token),
+            lambda token: self._swf.get_workflow_execution_history(self.domain, run_id, workflow_id, next_page_token=token, reverse_order=reverse_order),
         )
 
-        return {'events': [ev for response in response_iter for ev in response.get('events', [])]}
+        if self._instrumentation is not None:
+            response_iter = self._instrumented_pages('history', response_iter)
+        return (response.get('events', []) for response in response_iter)
+
+    def _snapshot(self, pid):
+        # history as far as it's in the snapshot store, if it is
+        events = self._snapshots.events(pid) if self._snapshots is not None else None
+        if not events:
+            return None
+
+        history = AmazonSWFHistory(codec=self._codec)
+        history.extend(events)
+        return history
+
+    def _add_to_snapshot(self, pid, events):
+        # snapshots only save fetching, so failing to write one doesn't fail the caller
+        if self._snapshots is not None and events:
+            try:
+                self._snapshots.append(pid, events)
+            except Exception:
+                logger.exception('Writing snapshot of %s failed', pid)
+
+    def _workflow_execution_history(self, description):
+        pid = AmazonSWFProcess.pid_from_description(description['execution'])
+        history = self._snapshot(pid)
+        if history is not None:
+            # only fetch events past the snapshot, newest to oldest
+            events = unseen_events(self._workflow_execution_pages(description, reverse_order=True), history.last_event_id)
+            history.extend(events)
+            self._add_to_snapshot(pid, events)
+            return history
+
+        # exhaustively query execution history using next_page_token, parsing it page by page
+        history = AmazonSWFHistory(codec=self._codec)
+        events = []
+        for page in self._workflow_execution_pages(description):
+            history.extend(page)
+            if self._snapshots is not None:
+                events += page
+
+        self._add_to_snapshot(pid, events)
+        return history
+
+    def _process_from_description(self, description, lazy=False):
+        if lazy or self._lazy_history:
+            pid = AmazonSWFProcess.pid_from_description(description['execution'])
+            history = AmazonSWFLazyHistory(self._snapshot(pid) or AmazonSWFHistory(codec=self._codec),
+                self._workflow_execution_pages(description, reverse_order=True),
+                on_read=lambda h, events: self._add_to_snapshot(pid, events))
+            return AmazonSWFProcess.from_description(description, history=history)
 
-    def _process_from_description(self, description):
         # get and fill in event history
         history = self._workflow_execution_history(description)
-        description.update(history)
-        process = AmazonSWFProcess.from_description(description)
-        return process
+        return AmazonSWFProcess.from_description(description, history=history)
 
     def process_by_id(self, process_id):
         workflow_id, run_id = process_id.split(':')
         description = self._swf.describe_workflow_execution(self.domain, run_id, workflow_id)
         return self._process_from_description(description['executionInfo'])
-    
-    def processes(self, workflow=None, tag=None):
+
+    def _execution_description(self, process_id):
+        workflow_id, run_id = process_id.split(':')
+        return {'execution': {'workflowId': workflow_id, 'runId': run_id}}
+
+    def history_pages(self, process_id, reverse_order=False):
+        # pages of event descriptions in the execution history of a process, fetched as they're consumed
+        return self._workflow_execution_pages(self._execution_description(process_id), reverse_order=reverse_order or None)
+
+    def process_history(self, process_id):
+        # the whole execution history of a process, as an AmazonSWFHistory
+        return self._workflow_execution_history(self._execution_description(process_id))
+
+    def _execution_filters(self, workflow=None, tag=None, started_after=None, started_before=None, closed=False, close_status=None):
+        # SWF takes at most one of the workflow, tag and close status filters
         if workflow and tag:
-            raise Exception('Amazon SWF does not support filtering on "workflow" and "tag" at the same time')
+            raise ValueError('Amazon SWF does not support filtering on "workflow" and "tag" at the same time')
+
+        if close_status and not closed:
+            raise ValueError('Filtering on close_status is only supported for closed processes')
+
+        if close_status and (workflow or tag):
+            raise ValueError('Amazon SWF does not support filtering on "close_status" together with "workflow" or "tag"')
 
         # Max lifetime of workflow executions in SWF is 1 year
-        after_date = datetime.now() - timedelta(days=365)
-        oldest_timestamp = time.mktime(after_date.timetuple())
+        started_after = started_after or (datetime.now() - timedelta(days=365))
+        oldest_timestamp = time.mktime(started_after.timetuple())
+        latest_timestamp = time.mktime(started_before.timetuple()) if started_before else None
+
+        if closed:
+            return {
+                'start_oldest_date': oldest_timestamp,
+                'start_latest_date': latest_timestamp,
+                'close_status': close_status,
+                'workflow_name': workflow,
+                'tag': tag
+            }
+        else:
+            return {
+                'oldest_date': oldest_timestamp,
+                'latest_date': latest_timestamp,
+                'workflow_name': workflow,
+                'tag': tag
+            }
+
+    def processes(self, workflow=None, tag=None, with_history=True, started_after=None, started_before=None, closed=False, close_status=None):
+        filters = self._execution_filters(workflow, tag, started_after, started_before, closed, close_status)
+        list_executions = self._swf.list_closed_workflow_executions if closed else self._swf.list_open_workflow_executions
 
         response_iter = self._consume_until_exhaustion(
-            lambda token: self._swf.list_open_workflow_executions(self.domain, oldest_timestamp, workflow_name=workflow, tag=tag if input else None, next_page_token=token)
+            lambda token: list_executions(self.domain, next_page_token=token, **filters)
         )
 
-        return imap(lambda d: self._process_from_description(d), (d for response in response_iter for d in response['executionInfos']))
+        descriptions = (d for response in response_iter for d in response['executionInfos'])
+        if not with_history:
+            # history is only fetched if it's read
+            return imap(lambda d: self._process_from_description(d, lazy=True), descriptions)
+
+        if self._lazy_history or self._fetch_width <= 1:
+            # nothing to gain from fetching ahead
+            return imap(self._process_from_description, descriptions)
+
+        # fetch histories for upcoming executions while earlier ones are consumed
+        return parallel_imap(self._process_from_description, descriptions, width=self._fetch_width)
+
+    def count_processes(self, workflow=None, tag=None, started_after=None, started_before=None, closed=False, close_status=None):
+        filters = self._execution_filters(workflow, tag, started_after, started_before, closed, close_status)
+
+        if closed:
+            response = self._swf.count_closed_workflow_executions(self.domain, **filters)
+        else:
+            # SWF requires an upper bound when counting open executions
+            filters['latest_date'] = filters['latest_date'] or time.time()
+            response = self._swf.count_open_workflow_executions(self.domain, **filters)
+
+        return response['count']
 
     def poll_activity_task(self, category=Defaults.ACTIVITY_CATEGORY, identity=None):
         description = self._swf.poll_for_activity_task(self.domain, category, identity=identity)
-        return activity_task_from_description(description) if description else None
+        task = activity_task_from_description(description, codec=self._codec) if description else None
+
+        if self._instrumentation is not None:
+            self._instrumentation.count('activity_task.tasks' if task else 'activity_task.empty_polls')
+
+        if task and self._heartbeats is not None:
+            timeout = self.heartbeat_timeout(task.activity_execution.activity)
+            if timeout:
+                self._heartbeats.track(task.context['token'], timeout)
+
+        return task
+
+    def _checkin_history(self, pid, history, events):
+        if self._history_cache is not None:
+            self._history_cache.checkin(pid, history)
+        self._add_to_snapshot(pid, events)
 
     def poll_decision_task(self, category=Defaults.DECISION_CATEGORY, identity=None):
+        instrumentation = self._instrumentation
+        # with snapshots, pages are fetched newest to oldest so they can stop at the snapshot
+        reverse_order = self._lazy_history or self._snapshots is not None
         response_iter = self._consume_until_exhaustion(
-            lambda token: self._swf.poll_for_decision_task(self.domain, category, identity=identity, next_page_token=token),
+            lambda token: self._swf.poll_for_decision_task(self.domain, category, identity=identity, next_page_token=token, reverse_order=reverse_order or None),
         )
+        if instrumentation is not None:
+            response_iter = self._instrumented_pages('decision_task', response_iter)
 
         description = next(response_iter, None)
-        if description and description.get('events',None):
-            description['events'] += [ev for response in response_iter for ev in response.get('events', [])]
-            return decision_task_from_description(description)
-        else:
-            return None
\ No newline at end of file
+        if not description or not description.get('events', None):
+            if instrumentation is not None:
+                instrumentation.count('decision_task.empty_polls')
+            return None
+
+        if instrumentation is not None:
+            instrumentation.count('decision_task.tasks')
+
+        # when SWF handed out the task, before the rest of its history is paged through
+        received = time.time()
+
+        pid = AmazonSWFProcess.pid_from_description(description['workflowExecution'])
+        history = self._history_cache.checkout(pid) if self._history_cache is not None else None
+        history = history or self._snapshot(pid) or AmazonSWFHistory(codec=self._codec)
+
+        if self._lazy_history:
+            # the rest of the pages are fetched newest to oldest when the history is first read,
+            # stopping as soon as they reach events that were already cached or snapshotted
+            pages = (response.get('events', []) for response in chain([description], response_iter))
+            on_parsed = (lambda seconds: instrumentation.observe('decision_task.parse', seconds)) if instrumentation is not None else None
+            lazy_history = AmazonSWFLazyHistory(history, pages, on_read=lambda h, events: self._checkin_history(pid, h, events), on_parsed=on_parsed)
+            task = decision_task_from_description(description, history=lazy_history)
+            task.context['received'] = received
+            return task
+
+        pages = chain([description.pop('events')], (response.get('events', []) for response in response_iter))
+        if reverse_order:
+            # only fetch pages until they reach events that are known
+            pages = [unseen_events(pages, history.last_event_id)]
+
+        # parse page by page, so raw event descriptions don't outlive parsing. time spent parsing
+        # is measured apart from time spent waiting for pages.
+        parsing = 0.0
+        events = []
+        for page in pages:
+            started = time.time()
+            history.extend(page)
+            parsing += time.time() - started
+            if self._snapshots is not None:
+                events += page
+
+        started = time.time()
+        task = decision_task_from_description(description, history=history)
+        task.context['received'] = received
+        if instrumentation is not None:
+            instrumentation.observe('decision_task.parse', parsing + time.time() - started)
+
+        self._checkin_history(pid, history, events)
+        return task
+
+    def decision_loop(self, decide, category=Defaults.DECISION_CATEGORY, identity=None, depth=1, stop=None):
+        # decides tasks with decide until the stop event is set, while polling up to depth tasks ahead
+        DecisionPipeline(self, decide, category, identity, depth).run(stop)
@@ -0,0 +1,258 @@
+import sys
+import gc
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+from pyworkflow.process import Process
+from pyworkflow.decision import ScheduleActivity, CompleteProcess
+from pyworkflow.events import ActivityEvent, DecisionEvent
+
+from process import AmazonSWFProcess
+from task import decision_task_from_description
+from decision import AmazonSWFDecision
+from backend import AmazonSWFBackend, AmazonSWFConfiguration
+from codec import default_codec
+from local import LocalSWF, attributes_key
+from worker import ActivityWorker, DecisionWorker
+
+# run time and peak rss may regress by this fraction of the baseline before it's reported
+TOLERANCE = 0.2
+
+MODULE = 'pyworkflow.amazonswf.benchmark'
+
+BENCHMARKS = ['from_description', 'decision_task_from_description', 'decisions']
+
+class HistoryBuilder(object):
+    # builds SWF event descriptions, the way they come back from a poll or history page
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, event_type, **attributes):
+        event_id = len(self.events) + 1
+        self.events.append({
+            'eventId': event_id,
+            'eventType': event_type,
+            'eventTimestamp': 1400000000.0 + event_id,
+            attributes_key(event_type): attributes
+        })
+        return event_id
+
+    def decision(self):
+        scheduled = self.add('DecisionTaskScheduled', taskList={'name': 'decisions'})
+        started = self.add('DecisionTaskStarted', scheduledEventId=scheduled)
+        return (scheduled, started)
+
+    def completed(self, scheduled, started):
+        return self.add('DecisionTaskCompleted', scheduledEventId=scheduled, startedEventId=started)
+
+def synthetic_history(activities=100, timers=10, children=10, signals=10, payload_size=100):
+    # a run that fans out to activities, timers and child processes in its first decision, with
+    # signals coming in while they complete, and a decision task for every completion
+    payload = default_codec.encode({'data': 'x' * payload_size})
+    history = HistoryBuilder()
+
+    history.add('WorkflowExecutionStarted', input=payload, tagList=['benchmark'], taskList={'name': 'decisions'},
+        workflowType={'name': 'benchmark', 'version': '1.0'}, childPolicy='ABANDON')
+    completed = history.completed(*history.decision())
+
+    scheduled = [history.add('ActivityTaskScheduled', activityId='activity-%d' % i, activityType={'name': 'benchmark', 'version': '1.0'},
+        input=payload, decisionTaskCompletedEventId=completed) for i in range(activities)]
+    started_timers = [history.add('TimerStarted', timerId='timer-%d' % i, startToFireTimeout='10', control=payload,
+        decisionTaskCompletedEventId=completed) for i in range(timers)]
+    initiated = [history.add('StartChildWorkflowExecutionInitiated', workflowId='child-%d' % i, workflowType={'name': 'child', 'version': '1.0'},
+        input=payload, tagList=[], decisionTaskCompletedEventId=completed) for i in range(children)]
+
+    def respond():
+        history.completed(*history.decision())
+
+    for (i, scheduled_event_id) in enumerate(scheduled):
+        started = history.add('ActivityTaskStarted', scheduledEventId=scheduled_event_id)
+        history.add('ActivityTaskCompleted', scheduledEventId=scheduled_event_id, startedEventId=started, result=payload)
+        if signals and i % max(1, activities // signals) == 0:
+            history.add('WorkflowExecutionSignaled', signalName='signal', input=payload)
+        respond()
+
+    for (i, started) in enumerate(started_timers):
+        history.add('TimerFired', timerId='timer-%d' % i, startedEventId=started)
+        respond()
+
+    for (i, initiated_event_id) in enumerate(initiated):
+        history.add('ChildWorkflowExecutionCompleted', initiatedEventId=initiated_event_id, result=payload,
+            workflowExecution={'workflowId': 'child-%d' % i, 'runId': 'run'}, workflowType={'name': 'child', 'version': '1.0'})
+        respond()
+
+    history.decision()
+    return history.events
+
+def decision_task_description(events):
+    return {
+        'taskToken': 'token',
+        'workflowExecution': {'workflowId': 'benchmark', 'runId': 'run'},
+        'workflowType': {'name': 'benchmark', 'version': '1.0'},
+        'events': events
+    }
+
+def measure(fn, repeat):
+    # best time out of repeat runs, along with how many kB the peak rss grew while running. peak
+    # rss only grows, so this is only meaningful in a fresh interpreter, see bench_in_subprocess
+    gc.collect()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return (min(timings), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak)
+
+def bench_from_description(events, repeat):
+    description = decision_task_description(events)
+    return measure(lambda: list(AmazonSWFProcess.from_description(description).history), repeat)
+
+def bench_decision_task(events, repeat):
+    description = decision_task_description(events)
+    return measure(lambda: list(decision_task_from_description(description).process.history), repeat)
+
+def bench_decisions(count, repeat):
+    config = AmazonSWFConfiguration()
+    config.config_activity('benchmark', {'taskList': {'name': 'activities'}, 'heartbeatTimeout': '60',
+        'scheduleToStartTimeout': '60', 'scheduleToCloseTimeout': '120', 'startToCloseTimeout': '60'})
+    decisions = [ScheduleActivity('benchmark', id='activity-%d' % i, input={'i': i}) for i in range(count)]
+    return measure(lambda: AmazonSWFDecision.descriptions(decisions, config), repeat)
+
+def bench(name, args):
+    # runs a single benchmark, returns its best time, peak rss growth and how many units it handled
+    events = synthetic_history(args.activities, args.timers, args.children, args.signals, args.payload_size)
+    if name == 'from_description':
+        return bench_from_description(events, args.repeat) + (len(events),)
+    if name == 'decision_task_from_description':
+        return bench_decision_task(events, args.repeat) + (len(events),)
+    return bench_decisions(args.activities, args.repeat) + (args.activities,)
+
+def bench_in_subprocess(name, args):
+    # every benchmark runs in a fresh interpreter, so its peak rss isn't hidden by what ran before
+    argv = ['--activities', args.activities, '--timers', args.timers, '--children', args.children,
+        '--signals', args.signals, '--payload-size', args.payload_size, '--repeat', args.repeat, '--only', name]
+    output = subprocess.check_output([sys.executable, '-m', MODULE] + [str(arg) for arg in argv])
+    return json.loads(output)
+
+def bench_throughput(processes, activities, pollers=2, size=4, prefetch=0, timeout=300, **backend_kwargs):
+    # runs processes that each schedule activities, end to end against a LocalSWF with a decision
+    # and an activity worker, returns the time it took along with how many decision tasks were decided.
+    # raises RuntimeError when they haven't all closed after timeout seconds
+    swf = LocalSWF(poll_timeout=0.5)
+    backend = AmazonSWFBackend(None, None, domain='benchmark', connection_factory=lambda: swf, **backend_kwargs)
+    backend.register_workflow('benchmark')
+    backend.register_activity('benchmark')
+
+    decided = [0]
+    def decide(task):
+        decided[0] += 1
+        history = task.process.history
+        completed = sum(1 for event in history if isinstance(event, ActivityEvent))
+        if not completed and not any(isinstance(event, DecisionEvent) for event in history):
+            return [ScheduleActivity('benchmark', id='activity-%d' % i, input=i) for i in range(activities)]
+        return [CompleteProcess(result=completed)] if completed == activities else []
+
+    workers = [DecisionWorker(backend, decide, pollers=pollers, size=size), ActivityWorker(backend, lambda task: task.activity_execution.input, pollers=pollers, size=size, prefetch=prefetch)]
+
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    try:
+        backend.start_processes([Process(workflow='benchmark') for _ in range(processes)])
+
+        while backend.count_processes(closed=True) < processes:
+            if time.time() - start > timeout:
+                raise RuntimeError('Processes did not all close within %d seconds' % timeout)
+            time.sleep(0.01)
+        elapsed = time.time() - start
+    finally:
+        for worker in workers:
+            worker.stop()
+    return (elapsed, decided[0])
+
+def run(args):
+    n = len(synthetic_history(args.activities, args.timers, args.children, args.signals, args.payload_size))
+
+    results = {}
+    for name in BENCHMARKS:
+        seconds, memory, units = bench_in_subprocess(name, args)
+        results[name] = {'per_unit': seconds / units, 'total': seconds, 'peak_rss_per_unit': memory * 1024.0 / units}
+
+    if args.processes:
+        seconds, decided = bench_throughput(args.processes, args.process_activities, prefetch=args.prefetch, timeout=args.timeout)
+        results['throughput'] = {'per_unit': seconds / decided, 'total': seconds, 'decisions_per_second': decided / seconds}
+
+    return (n, results)
+
+def report(n, results, baseline=None):
+    # returns the names of benchmarks that regressed against the baseline
+    print '%d events per history' % n
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        line = '%-32s %10.2f us/unit %10.3f s total' % (name, result['per_unit'] * 1e6, result['total'])
+        if 'peak_rss_per_unit' in result:
+            line += ' %8.1f B/unit peak rss' % result['peak_rss_per_unit']
+        if 'decisions_per_second' in result:
+            line += ' %8.1f decisions/s' % result['decisions_per_second']
+
+        previous = (baseline or {}).get(name, None)
+        if previous:
+            change = result['per_unit'] / previous['per_unit'] - 1
+            line += ' %+7.1f%%' % (change * 100)
+            regressed = change > TOLERANCE
+
+            if previous.get('peak_rss_per_unit') and 'peak_rss_per_unit' in result:
+                change = result['peak_rss_per_unit'] / previous['peak_rss_per_unit'] - 1
+                line += ' %+7.1f%% rss' % (change * 100)
+                regressed = regressed or change > TOLERANCE
+
+            if regressed:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print line
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark history parsing, decision building and worker throughput')
+    parser.add_argument('--activities', type=int, default=500, help='activities per synthetic history')
+    parser.add_argument('--timers', type=int, default=50, help='timers per synthetic history')
+    parser.add_argument('--children', type=int, default=50, help='child processes per synthetic history')
+    parser.add_argument('--signals', type=int, default=50, help='signals per synthetic history')
+    parser.add_argument('--payload-size', type=int, default=200, help='bytes per payload')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the best one counts')
+    parser.add_argument('--processes', type=int, default=20, help='processes to run end to end, 0 to skip')
+    parser.add_argument('--process-activities', type=int, default=10, help='activities per process run end to end')
+    parser.add_argument('--prefetch', type=int, default=0, help='activity tasks the activity worker polls ahead')
+    parser.add_argument('--timeout', type=int, default=300, help='seconds to wait for the processes run end to end')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against results saved with --save')
+    parser.add_argument('--save', metavar='PATH', help='save results as a baseline')
+    parser.add_argument('--only', choices=BENCHMARKS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.only:
+        # a single benchmark, run by bench_in_subprocess
+        print json.dumps(bench(args.only, args))
+        return 0
+
+    n, results = run(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = report(n, results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+from collections import OrderedDict
+from threading import Lock
+
+# Bounded LRU cache of parsed histories, keyed by process id (workflowId:runId)
+class HistoryCache(object):
+
+    def __init__(self, size=100):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def checkout(self, pid):
+        # histories are removed while in use, so two concurrent decision tasks
+        # for the same run never extend the same history
+        with self._lock:
+            return self._entries.pop(pid, None)
+
+    def checkin(self, pid, history):
+        if history.closed:
+            return
+
+        # events are built again from the history's records when it's read next
+        history.release()
+
+        with self._lock:
+            self._entries.pop(pid, None)
+            self._entries[pid] = history
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def evict(self, pid):
+        with self._lock:
+            self._entries.pop(pid, None)
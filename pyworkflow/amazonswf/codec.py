@@ -0,0 +1,70 @@
+import json
+import zlib
+import base64
+
+class JSONCodec(object):
+    # Encodes with the stdlib json module by default. Faster implementations such as ujson or
+    # simplejson can be passed in, JSONCodec(ujson), but differ in how they encode floats, large
+    # ints and non-ASCII text, so all hosts sharing a domain should use the same one.
+
+    def __init__(self, json_module=None):
+        self.json = json_module or json
+
+    def encode(self, value):
+        return self.json.dumps(value)
+
+    def decode(self, data):
+        return self.json.loads(data)
+
+default_codec = JSONCodec()
+
+class CompressingCodec(object):
+    # Wraps a codec, so payloads that encode to more than threshold bytes are compressed.
+    # Compressed payloads are base64 encoded behind a marker, anything without the marker
+    # is decoded as is, so histories written before compression was enabled still read.
+
+    MARKER = '~z1~'
+
+    def __init__(self, codec=None, threshold=1024, level=6):
+        self.codec = codec or default_codec
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        if len(data) > self.threshold:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            compressed = self.MARKER + base64.b64encode(zlib.compress(data, self.level))
+            # incompressible payloads are left alone
+            if len(compressed) < len(data):
+                data = compressed
+        return data
+
+    def decode(self, data):
+        if data.startswith(self.MARKER):
+            data = zlib.decompress(base64.b64decode(data[len(self.MARKER):])).decode('utf-8')
+        return self.codec.decode(data)
+
+class OffloadingCodec(object):
+    # Wraps a codec, so payloads that encode to more than threshold bytes are put in a
+    # PayloadStore and only a reference to them goes through SWF. References are resolved
+    # when decoding, which for history and tasks only happens once a value is read.
+
+    MARKER = '~ref1~'
+
+    def __init__(self, store, codec=None, threshold=16 * 1024):
+        self.store = store
+        self.codec = codec or default_codec
+        self.threshold = threshold
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        if len(data) > self.threshold:
+            data = self.MARKER + self.store.put(data)
+        return data
+
+    def decode(self, data):
+        if data.startswith(self.MARKER):
+            data = self.store.get(data[len(self.MARKER):])
+        return self.codec.decode(data)
@@ -0,0 +1,118 @@
+import time
+
+from Queue import LifoQueue, Empty
+from threading import BoundedSemaphore, Lock
+from contextlib import contextmanager
+
+from boto.exception import SWFResponseError
+
+from faults import is_throttling, is_transient
+
+class ConnectionPool(object):
+    # Bounded pool of keep-alive connections, created on demand. Callers wait for
+    # a connection once size connections are in use.
+
+    def __init__(self, factory, size=10):
+        self._factory = factory
+        self._idle = LifoQueue()
+        self._available = BoundedSemaphore(size)
+        self._connections = []
+        self._lock = Lock()
+
+    def _create(self):
+        connection = self._factory()
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        self._available.acquire()
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                connection = self._create()
+
+            try:
+                yield connection
+            finally:
+                self._idle.put(connection)
+        finally:
+            self._available.release()
+
+    def connections(self):
+        with self._lock:
+            return list(self._connections)
+
+    def close(self):
+        for connection in self.connections():
+            connection.close()
+
+class PooledLayer1(object):
+    # Stands in for a single boto Layer1 connection, running every call on a pooled one so
+    # it can be shared between threads. Long polls get a pool of their own, so they never
+    # hold up short calls. Calls optionally go through a RateLimiter, and failed calls are
+    # retried according to a RetryPolicy.
+
+    def __init__(self, factory, size=10, poll_size=10, limiter=None, retry=None, instrumentation=None):
+        self._pool = ConnectionPool(factory, size)
+        self._poll_pool = ConnectionPool(factory, poll_size)
+        self._limiter = limiter
+        self._retry = retry
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        pool = self._poll_pool if name.startswith('poll_for_') else self._pool
+        def call(*args, **kwargs):
+            return self._call(pool, name, args, kwargs)
+
+        call.__name__ = name
+        self.__dict__[name] = call
+        return call
+
+    def _call(self, pool, name, args, kwargs):
+        bucket = self._limiter.bucket(name) if self._limiter else None
+        attempt = 0
+
+        while True:
+            if bucket:
+                bucket.acquire()
+
+            started = time.time() if self._instrumentation else None
+            try:
+                with pool.connection() as connection:
+                    result = getattr(connection, name)(*args, **kwargs)
+            except SWFResponseError, e:
+                throttled = is_throttling(e)
+                if throttled and bucket:
+                    bucket.throttled()
+
+                if self._instrumentation:
+                    self._instrumentation.observe('swf.%s.latency' % name, time.time() - started)
+                    self._instrumentation.count('swf.%s.%s' % (name, 'throttled' if throttled else 'errors'))
+
+                if not is_transient(e) or not self._retry or not self._retry.should_retry(name, attempt, throttled):
+                    raise e
+
+                if self._instrumentation:
+                    self._instrumentation.count('swf.%s.retries' % name)
+                time.sleep(self._retry.delay(attempt))
+                attempt += 1
+                continue
+
+            if bucket:
+                bucket.succeeded()
+            if self._instrumentation:
+                self._instrumentation.observe('swf.%s.latency' % name, time.time() - started)
+            return result
+
+    def connections(self):
+        return self._pool.connections() + self._poll_pool.connections()
+
+    def close(self):
+        self._pool.close()
+        self._poll_pool.close()
@@ -1,29 +1,49 @@
-import json
 import uuid
 
 from pyworkflow.decision import ScheduleActivity, CancelActivity, CompleteProcess, CancelProcess, StartChildProcess, Timer
 
+from codec import default_codec
+
 class AmazonSWFDecision(object):
-    def __init__(self, decision, config):
-        if isinstance(decision, ScheduleActivity):
-            description = self.schedule_activity_description(decision, config)
-        elif isinstance(decision, CancelActivity):
-            description = self.cancel_activity_description(decision)
-        elif isinstance(decision, CompleteProcess):
-            description = self.complete_process_description(decision)
-        elif isinstance(decision, CancelProcess):
-            description = self.cancel_process_description(decision)
-        elif isinstance(decision, StartChildProcess):
-            description = self.start_child_process_description(decision, config)
-        elif isinstance(decision, Timer):
-            description = self.timer_description(decision)
-        else:
-            raise Exception('Invalid decision type')
-
-        self.description = description
-
-    def schedule_activity_description(cls, decision, config):
-        a_conf = config.for_activity(decision.activity, camelcase=True)
+
+    # timers the backend starts to continue responding with decisions that didn't fit a response
+    CONTINUATION_TIMER_PREFIX = 'continuation-'
+
+    # decision types with the methods that describe them, in order of precedence
+    DESCRIBERS = [
+        (ScheduleActivity, lambda self, decision, config: self.schedule_activity_description(decision, config)),
+        (CancelActivity, lambda self, decision, config: self.cancel_activity_description(decision)),
+        (CompleteProcess, lambda self, decision, config: self.complete_process_description(decision)),
+        (CancelProcess, lambda self, decision, config: self.cancel_process_description(decision)),
+        (StartChildProcess, lambda self, decision, config: self.start_child_process_description(decision, config)),
+        (Timer, lambda self, decision, config: self.timer_description(decision))
+    ]
+
+    _describers_by_type = {}
+
+    def __init__(self, decision=None, config=None, codec=None):
+        self.codec = codec or default_codec
+        self.description = self.describe(decision, config) if decision is not None else None
+
+    @classmethod
+    def _describer(cls, decision_type):
+        describer = cls._describers_by_type.get(decision_type, None)
+        if describer is None:
+            describer = next((fn for (t, fn) in cls.DESCRIBERS if issubclass(decision_type, t)), None)
+            if describer is None:
+                raise Exception('Invalid decision type')
+            cls._describers_by_type[decision_type] = describer
+        return describer
+
+    def describe(self, decision, config):
+        return self._describer(type(decision))(self, decision, config)
+
+    @classmethod
+    def descriptions(cls, decisions, config, codec=None):
+        describer = cls(codec=codec)
+        return [describer.describe(decision, config) for decision in decisions]
+
+    def schedule_activity_description(self, decision, config):
         attrs = {
             "activityId": str(decision.id),
             "activityType": {
@@ -31,10 +51,10 @@ class AmazonSWFDecision(object):
               "version": "1.0",
             },
             "control": None,
-            "input": json.dumps(decision.input) if decision.input else None
+            "input": self.codec.encode(decision.input) if decision.input else None
         }
 
-        attrs = dict(attrs.items() + a_conf.items())
+        attrs.update(config.activity_template(decision.activity))
         if decision.category:
             attrs['taskList'] = {
                 "name": decision.category
@@ -57,7 +77,7 @@ class AmazonSWFDecision(object):
         return {
             "decisionType": "CompleteWorkflowExecution",
             "completeWorkflowExecutionDecisionAttributes": {
-                "result": json.dumps(decision.result)
+                "result": self.codec.encode(decision.result)
             }
         }
 
@@ -73,7 +93,6 @@ class AmazonSWFDecision(object):
         if decision.process.id is not None:
             raise ValueError('AmazonSWF does not support manually assigned ids on a process. Process.id should be None.')
 
-        p_conf = config.for_workflow(decision.process.workflow, camelcase=True)
         attrs = {
             'workflowType': {
                 'name': decision.process.workflow,
@@ -81,23 +100,37 @@ class AmazonSWFDecision(object):
             },
             'workflowId': str(uuid.uuid4()),
             'childPolicy': decision.child_policy or 'ABANDON',
-            'input': json.dumps(decision.process.input),
+            'input': self.codec.encode(decision.process.input),
             'tagList': decision.process.tags
         }
 
-        attrs = dict(attrs.items() + p_conf.items())
+        attrs.update(config.workflow_template(decision.process.workflow))
 
         return {
             "decisionType": "StartChildWorkflowExecution",
             "startChildWorkflowExecutionDecisionAttributes": attrs
         }
 
+    @classmethod
+    def continuation_timer_description(cls, control=None):
+        attributes = {
+            "timerId": cls.CONTINUATION_TIMER_PREFIX + str(uuid.uuid4()),
+            "startToFireTimeout": "0"
+        }
+        if control is not None:
+            attributes["control"] = control
+
+        return {
+            "decisionType": "StartTimer",
+            "startTimerDecisionAttributes": attributes
+        }
+
     def timer_description(self, decision):
         return {
             "decisionType": "StartTimer",
             "startTimerDecisionAttributes": {
                 "timerId": str(uuid.uuid4()),
                 "startToFireTimeout": str(decision.delay),
-                "control": json.dumps(decision.data)
+                "control": self.codec.encode(decision.data)
             }
         }
\ No newline at end of file
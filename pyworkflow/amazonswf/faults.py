@@ -0,0 +1,10 @@
+def fault_type(error):
+    # SWF faults have a __type like 'com.amazonaws.swf.base.model#UnknownResourceFault'
+    return (getattr(error, 'body', None) or {}).get('__type', '').split('#')[-1]
+
+def is_throttling(error):
+    return fault_type(error) == 'ThrottlingException'
+
+def is_transient(error):
+    # failures on SWF's side, where the request may just succeed when tried again
+    return is_throttling(error) or getattr(error, 'status', 0) >= 500
@@ -0,0 +1,116 @@
+import time
+import logging
+
+from threading import Thread, Condition, Event
+
+logger = logging.getLogger(__name__)
+
+class Heartbeat(object):
+    __slots__ = ('interval', 'due', 'details', 'cancel_requested')
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.due = time.time() + interval
+        self.details = None
+        self.cancel_requested = False
+
+class HeartbeatScheduler(object):
+    # Sends heartbeats for every tracked activity task token from a single background thread,
+    # each at fraction of its heartbeat timeout. Explicit heartbeats in between are coalesced
+    # into the next scheduled one. send(token, details) records the heartbeat and returns the
+    # response. stop sends heartbeats whose details are still pending and stops the thread,
+    # tracking a task after that starts a new one.
+
+    def __init__(self, send, fraction=0.5):
+        self._send = send
+        self.fraction = fraction
+
+        self._heartbeats = {}
+        self._condition = Condition()
+        self._thread = None
+        self._stopping = None
+
+    def track(self, token, timeout):
+        with self._condition:
+            self._heartbeats[token] = Heartbeat(timeout * self.fraction)
+            if self._thread is None:
+                self._stopping = Event()
+                self._thread = Thread(target=self._run, args=(self._stopping,), name='HeartbeatScheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stopping.set()
+                self._condition.notify()
+
+        if thread is not None:
+            thread.join()
+
+    def untrack(self, token):
+        with self._condition:
+            self._heartbeats.pop(token, None)
+
+    def beat(self, token, details=None):
+        # returns False if the token isn't tracked, in which case the caller should send the heartbeat itself
+        with self._condition:
+            heartbeat = self._heartbeats.get(token, None)
+            if heartbeat is None:
+                return False
+            if details is not None:
+                heartbeat.details = details
+            return True
+
+    def cancel_requested(self, token):
+        with self._condition:
+            heartbeat = self._heartbeats.get(token, None)
+            return heartbeat.cancel_requested if heartbeat else False
+
+    def _due(self, stopping):
+        # returns None once stopping is set
+        with self._condition:
+            while not stopping.is_set():
+                now = time.time()
+                due = [(token, hb.details) for (token, hb) in self._heartbeats.items() if hb.due <= now]
+                if due:
+                    for (token, details) in due:
+                        heartbeat = self._heartbeats[token]
+                        heartbeat.due = now + heartbeat.interval
+                        heartbeat.details = None
+                    return due
+
+                next_due = min([hb.due for hb in self._heartbeats.values()] or [now + 60])
+                self._condition.wait(next_due - now)
+
+    def _beat(self, token, details):
+        try:
+            response = self._send(token, details)
+        except Exception:
+            logger.exception('Sending heartbeat failed')
+            return
+
+        if response and response.get('cancelRequested', False):
+            with self._condition:
+                heartbeat = self._heartbeats.get(token, None)
+                if heartbeat:
+                    heartbeat.cancel_requested = True
+
+    def _run(self, stopping):
+        while True:
+            # heartbeats are sent outside of the lock, so tracking never waits for the network
+            due = self._due(stopping)
+            if due is None:
+                break
+            for (token, details) in due:
+                self._beat(token, details)
+
+        # details that were coalesced into a heartbeat that's not due yet aren't lost
+        with self._condition:
+            pending = [(token, hb.details) for (token, hb) in self._heartbeats.items() if hb.details is not None]
+            for (token, details) in pending:
+                self._heartbeats[token].details = None
+        for (token, details) in pending:
+            self._beat(token, details)
@@ -0,0 +1,124 @@
+import math
+import time
+import logging
+
+from threading import Thread, Event, Lock
+
+logger = logging.getLogger(__name__)
+
+class Instrumentation(object):
+    # Receives measurements from the backend: observe is called with values that are
+    # aggregated into histograms (latencies in seconds, sizes), count with occurrences.
+    # Measurements are named like 'swf.poll_for_decision_task.latency' or 'decision_task.pages'.
+    # This one ignores them, backends without instrumentation skip measuring altogether.
+
+    def observe(self, name, value):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+class Histogram(object):
+    # values are kept in buckets that grow by a factor of BASE, so percentiles are approximate
+    BASE = 1.25
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        bucket = int(math.floor(math.log(value, self.BASE))) if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: float('-inf') if b is None else b):
+            seen += self.buckets[bucket]
+            if seen >= p * self.count:
+                value = 0 if bucket is None else self.BASE ** (bucket + 1)
+                return min(value, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99)
+        }
+
+class Aggregator(Instrumentation):
+    # Aggregates measurements in this process. snapshot returns them, and start dumps them to
+    # the log every interval seconds (or passes them to dump), starting over after each one.
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._since = time.time()
+        self._lock = Lock()
+        self._stopping = Event()
+        self._thread = None
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name, None)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(value)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            now = time.time()
+            snapshot = {
+                'seconds': now - self._since,
+                'histograms': dict((name, histogram.summary()) for (name, histogram) in self._histograms.items()),
+                'counters': dict(self._counters)
+            }
+            if reset:
+                self._histograms = {}
+                self._counters = {}
+                self._since = now
+        return snapshot
+
+    def log(self, snapshot):
+        lines = ['Measurements over the last %.0fs:' % snapshot['seconds']]
+        for (name, n) in sorted(snapshot['counters'].items()):
+            lines.append('  %-48s %10d %10.2f/s' % (name, n, n / snapshot['seconds']))
+        for (name, summary) in sorted(snapshot['histograms'].items()):
+            lines.append('  %-48s n=%d mean=%.4g p50=%.4g p90=%.4g p99=%.4g max=%.4g' % (name, summary['count'],
+                summary['mean'], summary['p50'], summary['p90'], summary['p99'], summary['max']))
+        logger.info('\n'.join(lines))
+
+    def start(self, interval=60, dump=None):
+        dump = dump or self.log
+
+        def run():
+            while not self._stopping.wait(interval):
+                dump(self.snapshot(reset=True))
+
+        self._stopping.clear()
+        self._thread = Thread(target=run, name='Aggregator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
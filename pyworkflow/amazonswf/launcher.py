@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+import argparse
+import importlib
+
+from pyworkflow.defaults import Defaults
+
+from worker import ActivityWorker, DecisionWorker
+
+logger = logging.getLogger(__name__)
+
+def load(path):
+    # resolves 'package.module:attribute'
+    module_name, _, attribute = path.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute) if attribute else module
+
+class Supervisor(object):
+    # Runs every target in a forked process of its own, and restarts targets that exit while
+    # the supervisor is running. On SIGTERM or SIGINT, children are asked to stop (they get
+    # SIGTERM) and are waited for.
+
+    RESTART_DELAY = 1
+
+    def __init__(self, targets):
+        # targets is a list of callables, each is called in a forked process
+        self.targets = targets
+        self._children = {}
+        self._stopping = False
+        self._pid = None
+
+    def _spawn(self, target):
+        pid = os.fork()
+        if pid == 0:
+            # until the target sets up its own handler, SIGTERM just ends the child
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+            code = 0
+            try:
+                target()
+            except Exception:
+                logger.exception('Worker process failed')
+                code = 1
+            finally:
+                os._exit(code)
+
+        self._children[pid] = (target, time.time())
+
+    def _stop(self, signum, frame):
+        if os.getpid() != self._pid:
+            # signalled in a child before it reset the handler
+            os._exit(1)
+
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        self._pid = os.getpid()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for target in self.targets:
+            self._spawn(target)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            target, started = self._children.pop(pid, (None, None))
+            if target and not self._stopping:
+                if os.WIFSIGNALED(status):
+                    logger.warning('Worker process %d was killed by signal %d, restarting', pid, os.WTERMSIG(status))
+                else:
+                    logger.warning('Worker process %d exited with status %d, restarting', pid, os.WEXITSTATUS(status))
+
+                # don't spin when a worker crashes right away
+                if time.time() - started < self.RESTART_DELAY:
+                    time.sleep(self.RESTART_DELAY)
+                if not self._stopping:
+                    self._spawn(target)
+
+def worker_target(worker_cls, backend_factory, handler, category, pollers, size, **kwargs):
+    def run():
+        # connections can't be shared across a fork, so each process makes its own backend
+        backend = backend_factory()
+        worker = worker_cls(backend, handler, categories=[category], pollers=pollers, size=size, **kwargs)
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop(wait=False))
+        worker.run()
+        backend.close()
+    return run
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run pyworkflow activity and decision workers for Amazon SWF')
+    parser.add_argument('backend', help='module:callable that returns an AmazonSWFBackend')
+    parser.add_argument('--activities', metavar='MODULE:CALLABLE', help='activity task handler')
+    parser.add_argument('--decisions', metavar='MODULE:CALLABLE', help='decision task handler')
+    parser.add_argument('--activity-list', action='append', dest='activity_lists', metavar='NAME',
+        help='activity task list to poll, can be repeated (default: %s)' % Defaults.ACTIVITY_CATEGORY)
+    parser.add_argument('--decision-list', action='append', dest='decision_lists', metavar='NAME',
+        help='decision task list to poll, can be repeated (default: %s)' % Defaults.DECISION_CATEGORY)
+    parser.add_argument('-n', '--processes', type=int, default=1, help='worker processes per task list')
+    parser.add_argument('--pollers', type=int, default=2, help='concurrent long polls per process')
+    parser.add_argument('--size', type=int, default=4, help='tasks handled concurrently per process')
+    parser.add_argument('--prefetch', type=int, default=0, help='activity tasks polled ahead per process while all handlers are busy')
+    parser.add_argument('--import', action='append', dest='imports', default=[], metavar='MODULE',
+        help='module to import before forking, can be repeated')
+    args = parser.parse_args(argv)
+
+    if not args.activities and not args.decisions:
+        parser.error('at least one of --activities and --decisions is required')
+
+    logging.basicConfig(level=logging.INFO)
+
+    # import everything up front, so forked processes share it copy-on-write
+    for module in args.imports:
+        importlib.import_module(module)
+    backend_factory = load(args.backend)
+
+    targets = []
+    if args.activities:
+        handler = load(args.activities)
+        for category in args.activity_lists or [Defaults.ACTIVITY_CATEGORY]:
+            targets += [worker_target(ActivityWorker, backend_factory, handler, category, args.pollers, args.size, prefetch=args.prefetch)] * args.processes
+
+    if args.decisions:
+        handler = load(args.decisions)
+        for category in args.decision_lists or [Defaults.DECISION_CATEGORY]:
+            targets += [worker_target(DecisionWorker, backend_factory, handler, category, args.pollers, args.size)] * args.processes
+
+    Supervisor(targets).run()
+
+if __name__ == '__main__':
+    sys.exit(main())
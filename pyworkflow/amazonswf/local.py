@@ -0,0 +1,722 @@
+import time
+import uuid
+import heapq
+
+from threading import Condition
+from collections import deque
+
+from boto.exception import SWFResponseError
+
+def fault(name, message='', status=400):
+    return SWFResponseError(status, 'Bad Request', {'__type': 'com.amazonaws.swf.base.model#%s' % name, 'message': message})
+
+def timeout_seconds(timeout):
+    return None if timeout is None or str(timeout) == 'NONE' else float(timeout)
+
+def attributes_key(event_type):
+    return '%s%sEventAttributes' % (event_type[0].lower(), event_type[1:])
+
+class LocalExecution(object):
+
+    def __init__(self, domain, workflow_id, workflow_type, task_list, tags, parent=None, execution_timeout=None, task_timeout=None, child_policy=None):
+        self.domain = domain
+        self.workflow_id = workflow_id
+        self.run_id = uuid.uuid4().hex
+        self.workflow_type = workflow_type
+        self.task_list = task_list
+        self.tags = tags or []
+        self.parent = parent
+        self.initiated_event_id = None
+        self.execution_timeout = execution_timeout
+        self.task_timeout = task_timeout
+        self.child_policy = child_policy
+
+        self.started = time.time()
+        self.closed = None
+        self.close_status = None
+        self.events = []
+
+        # decision task state: scheduled and started event ids, and whether anything happened
+        # since the decision task that is in progress was started
+        self.decision_scheduled = None
+        self.decision_started = None
+        self.previous_started = 0
+        self.needs_decision = False
+
+        # open activities by scheduled event id, and open timers by timer id
+        self.activities = {}
+        self.timers = {}
+
+    @property
+    def execution(self):
+        return {'workflowId': self.workflow_id, 'runId': self.run_id}
+
+    def info(self):
+        info = {
+            'execution': self.execution,
+            'workflowType': self.workflow_type,
+            'startTimestamp': self.started,
+            'executionStatus': 'CLOSED' if self.closed else 'OPEN',
+            'tagList': self.tags,
+            'cancelRequested': False
+        }
+        if self.closed:
+            info['closeTimestamp'] = self.closed
+            info['closeStatus'] = self.close_status
+        if self.parent:
+            info['parent'] = self.parent.execution
+        return info
+
+class LocalSWF(object):
+    # In-memory stand-in for the Layer1 calls AmazonSWFBackend makes, for tests and benchmarks
+    # that shouldn't need SWF. One instance is one SWF service, shared by every connection:
+    #
+    #   swf = LocalSWF()
+    #   backend = AmazonSWFBackend(None, None, connection_factory=lambda: swf)
+    #
+    # Decision and activity tasks, long polls, history paging and the decision, activity and
+    # timer timeouts behave as they do in SWF. Every call takes latency seconds, long polls
+    # return empty after poll_timeout seconds, and history is paged page_size events at a time.
+
+    MAX_DECISIONS = 100
+
+    def __init__(self, page_size=1000, poll_timeout=60, latency=0):
+        self.page_size = page_size
+        self.poll_timeout = poll_timeout
+        self.latency = latency
+        self.host = 'localhost'
+
+        self._condition = Condition()
+        self._types = {}
+        self._executions = {}
+        self._open = {}
+        self._decision_tasks = {}
+        self._activity_tasks = {}
+        self._tokens = {}
+        self._deadlines = []
+        self._sequence = 0
+
+    def close(self):
+        pass
+
+    # state changes below are made holding the condition
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _at(self, due, fn, *args):
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (due, self._sequence, fn, args))
+        self._condition.notify_all()
+
+    def _advance(self):
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            due, _, fn, args = heapq.heappop(self._deadlines)
+            fn(*args)
+
+    def _next_deadline(self):
+        return self._deadlines[0][0] if self._deadlines else None
+
+    def _event(self, execution, event_type, **attributes):
+        event_id = len(execution.events) + 1
+        execution.events.append({
+            'eventId': event_id,
+            'eventType': event_type,
+            'eventTimestamp': time.time(),
+            attributes_key(event_type): dict((k, v) for (k, v) in attributes.items() if v is not None)
+        })
+        return event_id
+
+    def _execution(self, domain, workflow_id, run_id=None):
+        self._advance()
+        if run_id:
+            execution = self._executions.get(run_id, None)
+        else:
+            execution = self._executions.get(self._open.get((domain, workflow_id), None), None)
+
+        if execution is None or execution.domain != domain or execution.workflow_id != workflow_id:
+            raise fault('UnknownResourceFault', 'Unknown execution: %s' % workflow_id)
+        return execution
+
+    def _open_execution(self, domain, workflow_id, run_id=None):
+        execution = self._execution(domain, workflow_id, run_id)
+        if execution.closed:
+            raise fault('UnknownResourceFault', 'Unknown execution: %s' % workflow_id)
+        return execution
+
+    def _type(self, domain, kind, name, version):
+        config = self._types.get((domain, kind, name, version), None)
+        if config is None:
+            raise fault('UnknownResourceFault', 'Unknown type: %s %s' % (kind, name))
+        return config
+
+    def _schedule_decision(self, execution):
+        if execution.closed:
+            return
+        if execution.decision_started is not None:
+            # scheduled once the decision task that is in progress completes
+            execution.needs_decision = True
+            return
+        if execution.decision_scheduled is not None:
+            return
+
+        execution.decision_scheduled = self._event(execution, 'DecisionTaskScheduled',
+            taskList={'name': execution.task_list}, startToCloseTimeout=str(execution.task_timeout))
+        self._decision_tasks.setdefault((execution.domain, execution.task_list), deque()).append(execution.run_id)
+        self._condition.notify_all()
+
+    def _close(self, execution, event_type, status, parent_event_type=None, **attributes):
+        self._event(execution, event_type, **attributes)
+        execution.closed = time.time()
+        execution.close_status = status
+        execution.activities = {}
+        execution.timers = {}
+        execution.decision_scheduled = execution.decision_started = None
+        del self._open[(execution.domain, execution.workflow_id)]
+
+        parent = execution.parent
+        if parent is not None and not parent.closed and parent_event_type:
+            parent_attributes = dict((k, v) for (k, v) in attributes.items() if k in ('result', 'details', 'reason', 'timeoutType'))
+            self._event(parent, parent_event_type, workflowExecution=execution.execution, workflowType=execution.workflow_type,
+                initiatedEventId=execution.initiated_event_id, **parent_attributes)
+            self._schedule_decision(parent)
+
+    def _execution_timed_out(self, run_id):
+        execution = self._executions[run_id]
+        if not execution.closed:
+            self._close(execution, 'WorkflowExecutionTimedOut', 'TIMED_OUT', 'ChildWorkflowExecutionTimedOut', timeoutType='START_TO_CLOSE')
+
+    def _decision_timed_out(self, run_id, started_event_id):
+        execution = self._executions[run_id]
+        if execution.closed or execution.decision_started != started_event_id:
+            return
+
+        self._event(execution, 'DecisionTaskTimedOut', timeoutType='START_TO_CLOSE',
+            scheduledEventId=execution.decision_scheduled, startedEventId=started_event_id)
+        execution.decision_scheduled = execution.decision_started = None
+        execution.needs_decision = False
+        self._schedule_decision(execution)
+
+    def _activity_timed_out(self, run_id, scheduled_event_id, timeout_type):
+        execution = self._executions[run_id]
+        activity = execution.activities.get(scheduled_event_id, None)
+        if activity is None:
+            return
+
+        if timeout_type == 'SCHEDULE_TO_START' and activity['started'] is not None:
+            return
+        if timeout_type == 'HEARTBEAT' and activity['heartbeat_due'] > time.time():
+            # heartbeats came in since, check again once the latest one times out
+            self._at(activity['heartbeat_due'], self._activity_timed_out, run_id, scheduled_event_id, 'HEARTBEAT')
+            return
+
+        self._finish_activity(execution, scheduled_event_id, 'ActivityTaskTimedOut', timeoutType=timeout_type, details=activity['details'])
+
+    def _finish_activity(self, execution, scheduled_event_id, event_type, **attributes):
+        activity = execution.activities.pop(scheduled_event_id)
+        if activity['token']:
+            self._tokens.pop(activity['token'], None)
+        self._event(execution, event_type, scheduledEventId=scheduled_event_id, startedEventId=activity['started'], **attributes)
+        self._schedule_decision(execution)
+
+    def _timer_fired(self, run_id, timer_id, started_event_id):
+        execution = self._executions[run_id]
+        if execution.timers.get(timer_id, None) != started_event_id:
+            return
+
+        del execution.timers[timer_id]
+        self._event(execution, 'TimerFired', timerId=timer_id, startedEventId=started_event_id)
+        self._schedule_decision(execution)
+
+    def _start(self, domain, workflow_id, workflow_name, workflow_version, task_list=None, child_policy=None,
+        execution_start_to_close_timeout=None, input=None, tag_list=None, task_start_to_close_timeout=None, parent=None):
+
+        if (domain, workflow_id) in self._open:
+            raise fault('WorkflowExecutionAlreadyStartedFault', 'Already started: %s' % workflow_id)
+
+        config = self._type(domain, 'workflow', workflow_name, workflow_version)
+        execution = LocalExecution(domain, workflow_id, {'name': workflow_name, 'version': workflow_version},
+            task_list or config['task_list'], tag_list, parent,
+            execution_start_to_close_timeout or config['default_execution_start_to_close_timeout'],
+            task_start_to_close_timeout or config['default_task_start_to_close_timeout'],
+            child_policy or config['default_child_policy'])
+
+        self._executions[execution.run_id] = execution
+        self._open[(domain, workflow_id)] = execution.run_id
+
+        self._event(execution, 'WorkflowExecutionStarted', input=input, tagList=execution.tags,
+            taskList={'name': execution.task_list}, workflowType=execution.workflow_type,
+            childPolicy=execution.child_policy, executionStartToCloseTimeout=str(execution.execution_timeout),
+            taskStartToCloseTimeout=str(execution.task_timeout),
+            parentWorkflowExecution=parent.execution if parent else None)
+
+        timeout = timeout_seconds(execution.execution_timeout)
+        if timeout is not None:
+            self._at(execution.started + timeout, self._execution_timed_out, execution.run_id)
+
+        self._schedule_decision(execution)
+        return execution
+
+    def _poll(self, queues, key, timeout):
+        deadline = time.time() + timeout
+        while True:
+            self._advance()
+
+            queue = queues.get(key, None)
+            if queue:
+                return queue.popleft()
+
+            now = time.time()
+            if now >= deadline:
+                return None
+
+            next_deadline = self._next_deadline()
+            self._condition.wait(min(deadline, next_deadline or deadline) - now)
+
+    def _page(self, events, page_size, next_page_token, reverse_order, **extra):
+        # page tokens carry everything needed to continue, like the opaque tokens of SWF
+        offset = int(next_page_token) if next_page_token else 0
+        events = list(reversed(events)) if reverse_order else events
+        page_size = page_size or self.page_size
+
+        response = dict(extra)
+        response['events'] = events[offset:offset + page_size]
+        if offset + page_size < len(events):
+            response['nextPageToken'] = str(offset + page_size)
+        return response
+
+    # types
+
+    def register_workflow_type(self, domain, name, version, task_list=None, default_child_policy=None,
+        default_execution_start_to_close_timeout=None, default_task_start_to_close_timeout=None, description=None):
+
+        self._call()
+        with self._condition:
+            key = (domain, 'workflow', name, version)
+            if key in self._types:
+                raise fault('TypeAlreadyExistsFault', 'Type already exists: %s' % name)
+            self._types[key] = {
+                'task_list': task_list,
+                'default_child_policy': default_child_policy,
+                'default_execution_start_to_close_timeout': default_execution_start_to_close_timeout,
+                'default_task_start_to_close_timeout': default_task_start_to_close_timeout,
+                'creationDate': time.time()
+            }
+
+    def register_activity_type(self, domain, name, version, task_list=None, default_task_heartbeat_timeout=None,
+        default_task_schedule_to_close_timeout=None, default_task_schedule_to_start_timeout=None,
+        default_task_start_to_close_timeout=None, description=None):
+
+        self._call()
+        with self._condition:
+            key = (domain, 'activity', name, version)
+            if key in self._types:
+                raise fault('TypeAlreadyExistsFault', 'Type already exists: %s' % name)
+            self._types[key] = {
+                'task_list': task_list,
+                'heartbeatTimeout': default_task_heartbeat_timeout,
+                'scheduleToCloseTimeout': default_task_schedule_to_close_timeout,
+                'scheduleToStartTimeout': default_task_schedule_to_start_timeout,
+                'startToCloseTimeout': default_task_start_to_close_timeout,
+                'creationDate': time.time()
+            }
+
+    def _describe_type(self, domain, kind, name, version):
+        self._call()
+        with self._condition:
+            config = self._type(domain, kind, name, version)
+            return {'typeInfo': {'%sType' % kind: {'name': name, 'version': version}, 'status': 'REGISTERED', 'creationDate': config['creationDate']}}
+
+    def describe_workflow_type(self, domain, workflow_name, workflow_version):
+        return self._describe_type(domain, 'workflow', workflow_name, workflow_version)
+
+    def describe_activity_type(self, domain, activity_name, activity_version):
+        return self._describe_type(domain, 'activity', activity_name, activity_version)
+
+    def _list_types(self, domain, kind, registration_status, maximum_page_size=None, name=None, next_page_token=None, reverse_order=None):
+        self._call()
+        with self._condition:
+            infos = [{'%sType' % kind: {'name': n, 'version': v}, 'status': 'REGISTERED', 'creationDate': config['creationDate']}
+                for ((d, k, n, v), config) in sorted(self._types.items()) if d == domain and k == kind and (name is None or n == name)]
+            if registration_status != 'REGISTERED':
+                infos = []
+
+        response = self._page(infos, maximum_page_size, next_page_token, reverse_order)
+        response['typeInfos'] = response.pop('events')
+        return response
+
+    def list_workflow_types(self, domain, registration_status, **kwargs):
+        return self._list_types(domain, 'workflow', registration_status, **kwargs)
+
+    def list_activity_types(self, domain, registration_status, **kwargs):
+        return self._list_types(domain, 'activity', registration_status, **kwargs)
+
+    # executions
+
+    def start_workflow_execution(self, domain, workflow_id, workflow_name, workflow_version, **kwargs):
+        self._call()
+        with self._condition:
+            return {'runId': self._start(domain, workflow_id, workflow_name, workflow_version, **kwargs).run_id}
+
+    def signal_workflow_execution(self, domain, signal_name, workflow_id, input=None, run_id=None):
+        self._call()
+        with self._condition:
+            execution = self._open_execution(domain, workflow_id, run_id)
+            self._event(execution, 'WorkflowExecutionSignaled', signalName=signal_name, input=input)
+            self._schedule_decision(execution)
+
+    def terminate_workflow_execution(self, domain, workflow_id, child_policy=None, details=None, reason=None, run_id=None):
+        self._call()
+        with self._condition:
+            execution = self._open_execution(domain, workflow_id, run_id)
+            self._close(execution, 'WorkflowExecutionTerminated', 'TERMINATED', 'ChildWorkflowExecutionTerminated',
+                details=details, reason=reason, childPolicy=child_policy or execution.child_policy, cause=None)
+
+    def request_cancel_workflow_execution(self, domain, workflow_id, run_id=None):
+        self._call()
+        with self._condition:
+            execution = self._open_execution(domain, workflow_id, run_id)
+            self._event(execution, 'WorkflowExecutionCancelRequested')
+            self._schedule_decision(execution)
+
+    def describe_workflow_execution(self, domain, run_id, workflow_id):
+        self._call()
+        with self._condition:
+            execution = self._execution(domain, workflow_id, run_id)
+            return {
+                'executionInfo': execution.info(),
+                'executionConfiguration': {
+                    'taskList': {'name': execution.task_list},
+                    'childPolicy': execution.child_policy,
+                    'executionStartToCloseTimeout': str(execution.execution_timeout),
+                    'taskStartToCloseTimeout': str(execution.task_timeout)
+                },
+                'openCounts': {
+                    'openActivityTasks': len(execution.activities),
+                    'openDecisionTasks': int(execution.decision_scheduled is not None),
+                    'openTimers': len(execution.timers),
+                    'openChildWorkflowExecutions': 0
+                }
+            }
+
+    def get_workflow_execution_history(self, domain, run_id, workflow_id, maximum_page_size=None, next_page_token=None, reverse_order=None):
+        self._call()
+        with self._condition:
+            events = list(self._execution(domain, workflow_id, run_id).events)
+        return self._page(events, maximum_page_size, next_page_token, reverse_order)
+
+    def _executions_matching(self, domain, closed, oldest_date=None, latest_date=None, tag=None, workflow_id=None,
+        workflow_name=None, workflow_version=None, close_status=None, close_oldest_date=None, close_latest_date=None):
+
+        self._advance()
+        for execution in self._executions.values():
+            if execution.domain != domain or bool(execution.closed) != closed:
+                continue
+            if oldest_date is not None and execution.started < oldest_date:
+                continue
+            if latest_date is not None and execution.started > latest_date:
+                continue
+            if close_oldest_date is not None and execution.closed < close_oldest_date:
+                continue
+            if close_latest_date is not None and execution.closed > close_latest_date:
+                continue
+            if tag is not None and tag not in execution.tags:
+                continue
+            if workflow_id is not None and execution.workflow_id != workflow_id:
+                continue
+            if workflow_name is not None and execution.workflow_type['name'] != workflow_name:
+                continue
+            if workflow_version is not None and execution.workflow_type['version'] != workflow_version:
+                continue
+            if close_status is not None and execution.close_status != close_status:
+                continue
+            yield execution
+
+    def _list_executions(self, domain, closed, maximum_page_size=None, next_page_token=None, reverse_order=None, **filters):
+        self._call()
+        with self._condition:
+            # newest first, unless reversed
+            executions = sorted(self._executions_matching(domain, closed, **filters), key=lambda e: e.started, reverse=True)
+            infos = [execution.info() for execution in executions]
+
+        response = self._page(infos, maximum_page_size, next_page_token, reverse_order)
+        response['executionInfos'] = response.pop('events')
+        return response
+
+    def list_open_workflow_executions(self, domain, oldest_date, latest_date=None, **kwargs):
+        return self._list_executions(domain, False, oldest_date=oldest_date, latest_date=latest_date, **kwargs)
+
+    def list_closed_workflow_executions(self, domain, start_latest_date=None, start_oldest_date=None, **kwargs):
+        return self._list_executions(domain, True, oldest_date=start_oldest_date, latest_date=start_latest_date, **kwargs)
+
+    def count_open_workflow_executions(self, domain, latest_date, oldest_date, **filters):
+        self._call()
+        with self._condition:
+            return {'count': len(list(self._executions_matching(domain, False, oldest_date, latest_date, **filters))), 'truncated': False}
+
+    def count_closed_workflow_executions(self, domain, start_latest_date=None, start_oldest_date=None, **filters):
+        self._call()
+        with self._condition:
+            return {'count': len(list(self._executions_matching(domain, True, start_oldest_date, start_latest_date, **filters))), 'truncated': False}
+
+    # decision tasks
+
+    def poll_for_decision_task(self, domain, task_list, identity=None, maximum_page_size=None, next_page_token=None, reverse_order=None):
+        self._call()
+        if next_page_token:
+            # further pages of the history of a decision task that was already handed out
+            run_id, last_event_id, offset = next_page_token.split(':')
+            with self._condition:
+                events = self._executions[run_id].events[:int(last_event_id)]
+            response = self._page(events, maximum_page_size, offset, reverse_order)
+            if 'nextPageToken' in response:
+                response['nextPageToken'] = '%s:%s:%s' % (run_id, last_event_id, response['nextPageToken'])
+            return response
+
+        with self._condition:
+            while True:
+                run_id = self._poll(self._decision_tasks, (domain, task_list), self.poll_timeout)
+                if run_id is None:
+                    return {'previousStartedEventId': 0, 'startedEventId': 0}
+
+                execution = self._executions[run_id]
+                if not execution.closed:
+                    break
+
+            started_event_id = self._event(execution, 'DecisionTaskStarted', scheduledEventId=execution.decision_scheduled, identity=identity)
+            execution.decision_started = started_event_id
+
+            token = uuid.uuid4().hex
+            self._tokens[token] = ('decision', run_id, started_event_id)
+
+            timeout = timeout_seconds(execution.task_timeout)
+            if timeout is not None:
+                self._at(time.time() + timeout, self._decision_timed_out, run_id, started_event_id)
+
+            events = list(execution.events)
+            previous_started_event_id = execution.previous_started
+
+        response = self._page(events, maximum_page_size, None, reverse_order,
+            taskToken=token, startedEventId=started_event_id, previousStartedEventId=previous_started_event_id,
+            workflowExecution=execution.execution, workflowType=execution.workflow_type)
+        if 'nextPageToken' in response:
+            response['nextPageToken'] = '%s:%d:%s' % (run_id, len(events), response['nextPageToken'])
+        return response
+
+    def _decision_task(self, task_token):
+        kind, run_id, started_event_id = self._tokens.get(task_token, (None, None, None))
+        execution = self._executions.get(run_id, None)
+        if kind != 'decision' or execution is None or execution.closed or execution.decision_started != started_event_id:
+            raise fault('UnknownResourceFault', 'Unknown task token')
+        return execution
+
+    def respond_decision_task_completed(self, task_token, decisions=None, execution_context=None):
+        self._call()
+        decisions = decisions or []
+        if len(decisions) > self.MAX_DECISIONS:
+            raise fault('ValidationException', 'At most %d decisions can be made at once' % self.MAX_DECISIONS)
+        if execution_context and len(execution_context) > 32768:
+            raise fault('ValidationException', 'executionContext is longer than 32768')
+        for decision in decisions:
+            decision_type = decision['decisionType']
+            attributes = decision.get('%s%sDecisionAttributes' % (decision_type[0].lower(), decision_type[1:]), {})
+            if len(attributes.get('control', None) or '') > 32768:
+                raise fault('ValidationException', 'control is longer than 32768')
+
+        with self._condition:
+            execution = self._decision_task(task_token)
+            del self._tokens[task_token]
+
+            completed_event_id = self._event(execution, 'DecisionTaskCompleted', executionContext=execution_context,
+                scheduledEventId=execution.decision_scheduled, startedEventId=execution.decision_started)
+            execution.previous_started = execution.decision_started
+            execution.decision_scheduled = execution.decision_started = None
+
+            for decision in decisions:
+                if execution.closed:
+                    break
+                self._decide(execution, completed_event_id, decision)
+
+            if execution.needs_decision:
+                execution.needs_decision = False
+                self._schedule_decision(execution)
+
+    def _decide(self, execution, completed_event_id, decision):
+        decision_type = decision['decisionType']
+        attributes = decision.get('%s%sDecisionAttributes' % (decision_type[0].lower(), decision_type[1:]), {})
+
+        if decision_type == 'ScheduleActivityTask':
+            activity_type = attributes['activityType']
+            config = self._type(execution.domain, 'activity', activity_type['name'], activity_type['version'])
+            timeouts = dict((key, attributes.get(key, None) or config[key])
+                for key in ['heartbeatTimeout', 'scheduleToCloseTimeout', 'scheduleToStartTimeout', 'startToCloseTimeout'])
+            task_list = attributes.get('taskList', {}).get('name', None) or config['task_list']
+
+            scheduled_event_id = self._event(execution, 'ActivityTaskScheduled', activityId=attributes['activityId'],
+                activityType=activity_type, input=attributes.get('input', None), control=attributes.get('control', None),
+                taskList={'name': task_list}, decisionTaskCompletedEventId=completed_event_id, **timeouts)
+
+            execution.activities[scheduled_event_id] = {
+                'activity_id': attributes['activityId'],
+                'activity_type': activity_type,
+                'input': attributes.get('input', None),
+                'timeouts': timeouts,
+                'started': None,
+                'token': None,
+                'details': None,
+                'heartbeat_due': None,
+                'cancel_requested': False
+            }
+            self._activity_tasks.setdefault((execution.domain, task_list), deque()).append((execution.run_id, scheduled_event_id))
+            self._condition.notify_all()
+
+            now = time.time()
+            for (timeout_type, key) in [('SCHEDULE_TO_START', 'scheduleToStartTimeout'), ('SCHEDULE_TO_CLOSE', 'scheduleToCloseTimeout')]:
+                timeout = timeout_seconds(timeouts[key])
+                if timeout is not None:
+                    self._at(now + timeout, self._activity_timed_out, execution.run_id, scheduled_event_id, timeout_type)
+
+        elif decision_type == 'RequestCancelActivityTask':
+            scheduled_event_id = next((event_id for (event_id, activity) in execution.activities.items()
+                if activity['activity_id'] == attributes['activityId']), None)
+            if scheduled_event_id is None:
+                self._event(execution, 'RequestCancelActivityTaskFailed', activityId=attributes['activityId'],
+                    cause='ACTIVITY_ID_UNKNOWN', decisionTaskCompletedEventId=completed_event_id)
+                self._schedule_decision(execution)
+                return
+
+            self._event(execution, 'ActivityTaskCancelRequested', activityId=attributes['activityId'], decisionTaskCompletedEventId=completed_event_id)
+            activity = execution.activities[scheduled_event_id]
+            if activity['started'] is None:
+                self._finish_activity(execution, scheduled_event_id, 'ActivityTaskCanceled')
+            else:
+                activity['cancel_requested'] = True
+
+        elif decision_type == 'CompleteWorkflowExecution':
+            self._close(execution, 'WorkflowExecutionCompleted', 'COMPLETED', 'ChildWorkflowExecutionCompleted',
+                result=attributes.get('result', None), decisionTaskCompletedEventId=completed_event_id)
+
+        elif decision_type == 'CancelWorkflowExecution':
+            self._close(execution, 'WorkflowExecutionCanceled', 'CANCELED', 'ChildWorkflowExecutionCanceled',
+                details=attributes.get('details', None), decisionTaskCompletedEventId=completed_event_id)
+
+        elif decision_type == 'FailWorkflowExecution':
+            self._close(execution, 'WorkflowExecutionFailed', 'FAILED', 'ChildWorkflowExecutionFailed',
+                reason=attributes.get('reason', None), details=attributes.get('details', None), decisionTaskCompletedEventId=completed_event_id)
+
+        elif decision_type == 'StartChildWorkflowExecution':
+            workflow_type = attributes['workflowType']
+            initiated_event_id = self._event(execution, 'StartChildWorkflowExecutionInitiated', workflowId=attributes['workflowId'],
+                workflowType=workflow_type, input=attributes.get('input', None), tagList=attributes.get('tagList', None) or [],
+                control=attributes.get('control', None), childPolicy=attributes.get('childPolicy', None),
+                taskList=attributes.get('taskList', None), decisionTaskCompletedEventId=completed_event_id)
+
+            child = self._start(execution.domain, attributes['workflowId'], workflow_type['name'], workflow_type['version'],
+                task_list=attributes.get('taskList', {}).get('name', None), child_policy=attributes.get('childPolicy', None),
+                execution_start_to_close_timeout=attributes.get('executionStartToCloseTimeout', None),
+                input=attributes.get('input', None), tag_list=attributes.get('tagList', None),
+                task_start_to_close_timeout=attributes.get('taskStartToCloseTimeout', None), parent=execution)
+            child.initiated_event_id = initiated_event_id
+
+            self._event(execution, 'ChildWorkflowExecutionStarted', workflowExecution=child.execution,
+                workflowType=workflow_type, initiatedEventId=initiated_event_id)
+            self._schedule_decision(execution)
+
+        elif decision_type == 'StartTimer':
+            timer_id = attributes['timerId']
+            started_event_id = self._event(execution, 'TimerStarted', timerId=timer_id, control=attributes.get('control', None),
+                startToFireTimeout=attributes['startToFireTimeout'], decisionTaskCompletedEventId=completed_event_id)
+            execution.timers[timer_id] = started_event_id
+            self._at(time.time() + float(attributes['startToFireTimeout']), self._timer_fired, execution.run_id, timer_id, started_event_id)
+
+        elif decision_type == 'CancelTimer':
+            started_event_id = execution.timers.pop(attributes['timerId'], None)
+            if started_event_id is not None:
+                self._event(execution, 'TimerCanceled', timerId=attributes['timerId'], startedEventId=started_event_id,
+                    decisionTaskCompletedEventId=completed_event_id)
+
+        elif decision_type == 'RecordMarker':
+            self._event(execution, 'MarkerRecorded', markerName=attributes['markerName'], details=attributes.get('details', None),
+                decisionTaskCompletedEventId=completed_event_id)
+
+        else:
+            raise fault('ValidationException', 'Unsupported decision type: %s' % decision_type)
+
+    # activity tasks
+
+    def poll_for_activity_task(self, domain, task_list, identity=None):
+        self._call()
+        with self._condition:
+            while True:
+                task = self._poll(self._activity_tasks, (domain, task_list), self.poll_timeout)
+                if task is None:
+                    return {'startedEventId': 0}
+
+                run_id, scheduled_event_id = task
+                execution = self._executions[run_id]
+                activity = execution.activities.get(scheduled_event_id, None)
+                if activity is not None and activity['started'] is None:
+                    break
+
+            now = time.time()
+            activity['started'] = self._event(execution, 'ActivityTaskStarted', scheduledEventId=scheduled_event_id, identity=identity)
+            activity['token'] = token = uuid.uuid4().hex
+            self._tokens[token] = ('activity', run_id, scheduled_event_id)
+
+            timeout = timeout_seconds(activity['timeouts']['startToCloseTimeout'])
+            if timeout is not None:
+                self._at(now + timeout, self._activity_timed_out, run_id, scheduled_event_id, 'START_TO_CLOSE')
+
+            timeout = timeout_seconds(activity['timeouts']['heartbeatTimeout'])
+            if timeout is not None:
+                activity['heartbeat_due'] = now + timeout
+                self._at(now + timeout, self._activity_timed_out, run_id, scheduled_event_id, 'HEARTBEAT')
+
+            return {
+                'taskToken': token,
+                'activityId': activity['activity_id'],
+                'activityType': activity['activity_type'],
+                'input': activity['input'],
+                'startedEventId': activity['started'],
+                'workflowExecution': execution.execution
+            }
+
+    def _activity_task(self, task_token):
+        kind, run_id, scheduled_event_id = self._tokens.get(task_token, (None, None, None))
+        execution = self._executions.get(run_id, None)
+        if kind != 'activity' or execution is None or scheduled_event_id not in execution.activities:
+            raise fault('UnknownResourceFault', 'Unknown task token')
+        return (execution, scheduled_event_id)
+
+    def respond_activity_task_completed(self, task_token, result=None):
+        self._call()
+        with self._condition:
+            execution, scheduled_event_id = self._activity_task(task_token)
+            self._finish_activity(execution, scheduled_event_id, 'ActivityTaskCompleted', result=result)
+
+    def respond_activity_task_failed(self, task_token, details=None, reason=None):
+        self._call()
+        with self._condition:
+            execution, scheduled_event_id = self._activity_task(task_token)
+            self._finish_activity(execution, scheduled_event_id, 'ActivityTaskFailed', details=details, reason=reason)
+
+    def respond_activity_task_canceled(self, task_token, details=None):
+        self._call()
+        with self._condition:
+            execution, scheduled_event_id = self._activity_task(task_token)
+            self._finish_activity(execution, scheduled_event_id, 'ActivityTaskCanceled', details=details)
+
+    def record_activity_task_heartbeat(self, task_token, details=None):
+        self._call()
+        with self._condition:
+            execution, scheduled_event_id = self._activity_task(task_token)
+            activity = execution.activities[scheduled_event_id]
+            activity['details'] = details
+
+            timeout = timeout_seconds(activity['timeouts']['heartbeatTimeout'])
+            if timeout is not None:
+                activity['heartbeat_due'] = time.time() + timeout
+
+            return {'cancelRequested': activity['cancel_requested']}
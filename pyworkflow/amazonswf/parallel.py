@@ -0,0 +1,20 @@
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+def parallel_imap(fn, iterable, width=8, window=None):
+    # like itertools.imap, but runs fn on up to width threads. Results are yielded
+    # in input order, and at most window items are in flight at any time
+    window = window or 2 * width
+    pool = ThreadPool(width)
+    pending = deque()
+
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
@@ -0,0 +1,72 @@
+from pyworkflow.process import Process, ProcessCompleted
+from pyworkflow.signal import Signal
+from pyworkflow.activity import ActivityCompleted, ActivityExecution
+from pyworkflow.decision import ScheduleActivity, Timer
+
+from codec import default_codec
+
+def decoded(value):
+    return value
+
+class Payload(object):
+    # Encoded payload that is only decoded once its value is read. If the payload is not
+    # strict, data that can't be decoded is returned as is.
+    __slots__ = ('data', 'codec', 'strict', '_value', '_decoded')
+
+    def __init__(self, data, codec=None, strict=True):
+        self.data = data
+        self.codec = codec or default_codec
+        self.strict = strict
+        self._value = None
+        self._decoded = False
+
+    def value(self):
+        if not self._decoded:
+            try:
+                self._value = self.codec.decode(self.data)
+            except ValueError:
+                if self.strict:
+                    raise
+                self._value = self.data
+            self._decoded = True
+        return self._value
+
+    def __reduce__(self):
+        # payloads are decoded before they're pickled, codecs and stores don't go along
+        return (decoded, (self.value(),))
+
+def payload_attribute(name):
+    def fget(self):
+        value = self.__dict__.get(name, None)
+        if isinstance(value, Payload):
+            value = value.value()
+            self.__dict__[name] = value
+        return value
+
+    def fset(self, value):
+        self.__dict__[name] = value
+
+    return property(fget, fset)
+
+# pyworkflow types that are created from history, with their payload decoded on first read
+
+class LazyProcess(Process):
+    input = payload_attribute('input')
+
+class LazyProcessCompleted(ProcessCompleted):
+    result = payload_attribute('result')
+
+class LazyActivityExecution(ActivityExecution):
+    input = payload_attribute('input')
+
+class LazyActivityCompleted(ActivityCompleted):
+    result = payload_attribute('result')
+
+class LazyScheduleActivity(ScheduleActivity):
+    input = payload_attribute('input')
+
+class LazyTimer(Timer):
+    data = payload_attribute('data')
+
+class LazySignal(Signal):
+    data = payload_attribute('data')
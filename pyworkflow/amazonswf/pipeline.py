@@ -0,0 +1,107 @@
+import time
+import logging
+
+from threading import Thread, Event
+from Queue import Queue, Full, Empty
+
+from pyworkflow.defaults import Defaults
+
+from admission import Admission
+
+logger = logging.getLogger(__name__)
+
+class DecisionPipeline(object):
+    # Decides decision tasks one at a time, while a background thread polls up to depth tasks
+    # ahead, history pages included, as long as they'd be decided within their workflow's
+    # taskStartToCloseTimeout. Tasks that timed out while waiting anyway are dropped instead
+    # of decided (SWF schedules them again), and counted in dropped. decide is called with a
+    # DecisionTask, and returns its decisions.
+
+    def __init__(self, backend, decide, category=Defaults.DECISION_CATEGORY, identity=None, depth=1):
+        self.backend = backend
+        self.decide = decide
+        self.category = category
+        self.identity = identity
+        self.dropped = 0
+
+        self._tasks = Queue()
+        self._slots = Queue(depth)
+        self._deciding = Event()
+        self._admission = Admission()
+
+    def _can_wait(self):
+        # whether a task polled now would be decided before it times out
+        return self._admission.admits(1 if self._deciding.is_set() else 0, self._tasks.qsize())
+
+    def _prefetch(self, stop):
+        while not stop.is_set():
+            # only poll while fewer than depth tasks are waiting to be decided
+            try:
+                self._slots.put(None, timeout=1)
+            except Full:
+                continue
+
+            if not self._can_wait():
+                self._slots.get_nowait()
+                stop.wait(0.1)
+                continue
+
+            try:
+                task = self.backend.poll_decision_task(category=self.category, identity=self.identity)
+                if task is not None:
+                    # lazy histories are read here, so their pages are fetched ahead too
+                    len(task.process.history)
+            except Exception:
+                logger.exception('Polling %s failed', self.category)
+                self._slots.get_nowait()
+                stop.wait(1)
+                continue
+
+            if task is None:
+                self._slots.get_nowait()
+            else:
+                self._tasks.put(task)
+
+    def _deadline(self, task):
+        # the timeout runs from when SWF handed out the task, paging through its history included
+        return self._admission.deadline(task.context['received'], self.backend.decision_timeout(task.process.workflow))
+
+    def _drop(self, task):
+        self.dropped += 1
+        if self.backend.instrumentation is not None:
+            self.backend.instrumentation.count('decision_task.dropped')
+        logger.warning('Dropping decision task for %s, it timed out while waiting', task.process.id)
+
+    def run(self, stop=None):
+        # runs until stop is set, and tasks that were polled by then are decided
+        stop = stop or Event()
+
+        thread = Thread(target=self._prefetch, args=(stop,), name='DecisionPipeline-%s' % self.category)
+        thread.daemon = True
+        thread.start()
+
+        while not stop.is_set() or thread.is_alive() or not self._tasks.empty():
+            try:
+                task = self._tasks.get(timeout=0.1)
+            except Empty:
+                continue
+            self._deciding.set()
+            self._slots.get_nowait()
+            try:
+                self._handle(task)
+            finally:
+                self._deciding.clear()
+
+    def _handle(self, task):
+        deadline = self._deadline(task)
+        started = time.time()
+        if deadline is not None and started >= deadline:
+            self._drop(task)
+            return
+
+        try:
+            self.backend.complete_decision_task(task, self.decide(task))
+        except Exception:
+            logger.exception('Deciding %s failed', task.process.id)
+
+        self._admission.finished(time.time() - started)
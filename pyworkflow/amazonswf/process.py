@@ -1,23 +1,85 @@
-import json
 from datetime import datetime
+import time
+from threading import Lock
 
-from pyworkflow.process import Process, ProcessCompleted, ProcessCanceled, ProcessTimedOut
+from pyworkflow.process import Process, ProcessCanceled, ProcessTimedOut
 from pyworkflow.events import Event, DecisionStartedEvent, DecisionEvent, ActivityEvent, ActivityStartedEvent, SignalEvent, ChildProcessEvent, TimerEvent, ProcessStartedEvent
-from pyworkflow.signal import Signal
-from pyworkflow.activity import ActivityCompleted, ActivityCanceled, ActivityFailed, ActivityTimedOut, ActivityExecution
-from pyworkflow.decision import ScheduleActivity, StartChildProcess, Timer
+from pyworkflow.activity import ActivityCompleted, ActivityCanceled, ActivityFailed, ActivityTimedOut
+from pyworkflow.decision import StartChildProcess
+
+from codec import default_codec
+from decision import AmazonSWFDecision
+from payload import Payload, LazyProcess, LazyProcessCompleted, LazyActivityExecution, LazyActivityCompleted, LazyScheduleActivity, LazyTimer, LazySignal
+
+# placeholder for process attributes that are only known once a lazy history has been read
+LAZY = object()
+
+def lazy_attribute(name):
+    def fget(self):
+        value = self.__dict__.get(name, None)
+        if value is LAZY:
+            value = getattr(self.history, name)
+            self.__dict__[name] = value
+        return value
+
+    def fset(self, value):
+        self.__dict__[name] = value
+
+    return property(fget, fset)
 
 class AmazonSWFProcess(Process):
+    input = lazy_attribute('input')
+    tags = lazy_attribute('tags')
+    parent = lazy_attribute('parent')
+
+    # events that are logically ordered by the decision that caused them
+    DECISION_EVENT_TYPES = ['ActivityTaskScheduled', 'StartChildWorkflowExecutionInitiated', 'TimerStarted']
+
+    # events that are looked up by the events that refer to them
+    RELATED_EVENT_TYPES = DECISION_EVENT_TYPES + ['DecisionTaskCompleted']
+
+    @classmethod
+    def _index(cls, event_descriptions):
+        return EventIndex((ev['eventId'], ev) for ev in event_descriptions)
 
     @classmethod
     def _related_event(cls, related, event_id):
-        return filter(lambda x: x['eventId'] == event_id, related)[0]
+        return related[event_id]
 
     @classmethod
     def _attributes(cls, event):
-        event_type = event['eventType']
-        return event.get(event_type[0].lower() + event_type[1:] + 'EventAttributes', {})
+        return event.get(attributes_key(event['eventType']), {})
         
+    @classmethod
+    def _payload(cls, event, key, related, strict=True):
+        data = cls._attributes(event).get(key, None)
+        if not data:
+            return None
+
+        if not isinstance(related, EventIndex):
+            return Payload(data, strict=strict)
+
+        # payloads are memoized per event, so that events sharing one are only decoded once
+        memo_key = (event['eventId'], key)
+        payload = related.payloads.get(memo_key, None)
+        if payload is None:
+            payload = related.payloads[memo_key] = Payload(data, codec=related.codec, strict=strict)
+        return payload
+
+    @classmethod
+    def event_order(cls, event, related):
+        if event['eventType'] not in cls.DECISION_EVENT_TYPES:
+            return event['eventId']
+
+        # logical order is start of decision, everything after needs to be considered in next decision
+        completed_event = cls._related_event(related, cls._attributes(event)['decisionTaskCompletedEventId'])
+        return completed_event['decisionTaskCompletedEventAttributes']['startedEventId']
+
+    @classmethod
+    def _is_continuation_timer(cls, attributes):
+        # timers of the backend itself are left out of history
+        return attributes.get('timerId', '').startswith(AmazonSWFDecision.CONTINUATION_TIMER_PREFIX)
+
     @classmethod
     def _decision_event(cls, event, related):
         event_id = event['eventId']
@@ -25,24 +87,24 @@ class AmazonSWFProcess(Process):
         event_type = event['eventType']
         attributes = cls._attributes(event)
 
-        completed_event = cls._related_event(related, attributes['decisionTaskCompletedEventId'])
-        started_event_id = completed_event['decisionTaskCompletedEventAttributes']['startedEventId']
-    
-        inp = json.loads(attributes['input']) if attributes.get('input', None) else None
+        started_event_id = cls.event_order(event, related)
+
+        inp = cls._payload(event, 'input', related)
 
         if event_type == 'ActivityTaskScheduled':
             activity_id = attributes['activityId']
             activity = attributes['activityType']['name']
-            decision = ScheduleActivity(activity=activity, id=activity_id, input=inp)
+            decision = LazyScheduleActivity(activity=activity, id=activity_id, input=inp)
 
         elif event_type == 'StartChildWorkflowExecutionInitiated':
-            process = Process(workflow=attributes['workflowType']['name'], input=inp, tags=attributes['tagList'])
+            process = LazyProcess(workflow=attributes['workflowType']['name'], input=inp, tags=attributes['tagList'])
             decision = StartChildProcess(process=process)
         
         elif event_type == 'TimerStarted':
-            decision = Timer(delay=int(attributes['startToFireTimeout']), data=json.loads(attributes['control']))
+            if cls._is_continuation_timer(attributes):
+                return None
+            decision = LazyTimer(delay=int(attributes['startToFireTimeout']), data=cls._payload(event, 'control', related))
         
-        # logical order is start of decision, everything after needs to be considered in next decision
         return (started_event_id, DecisionEvent(datetime=event_dt, decision=decision))
 
     @classmethod
@@ -55,15 +117,11 @@ class AmazonSWFProcess(Process):
         def event_with_result(result):
             scheduled_by = cls._related_event(related, attributes['scheduledEventId'])
             attrs = scheduled_by.get('activityTaskScheduledEventAttributes', None)
-            
-            try:
-                inp = json.loads(attrs['input']) if attrs.get('input', None) else None
-            except:
-                inp = attrs.get('input', None)
+            inp = cls._payload(scheduled_by, 'input', related, strict=False)
 
             kwargs = {
                 'date': event_dt,
-                'activity_execution': ActivityExecution(attrs['activityType']['name'], attrs['activityId'], inp),
+                'activity_execution': LazyActivityExecution(attrs['activityType']['name'], attrs['activityId'], inp),
             }
 
             event_cls = ActivityEvent if result else ActivityStartedEvent
@@ -75,8 +133,8 @@ class AmazonSWFProcess(Process):
         if event_type == 'ActivityTaskStarted':
             return event_with_result(None)
         elif event_type == 'ActivityTaskCompleted':
-            result = json.loads(attributes['result']) if 'result' in attributes.keys() else None
-            return event_with_result(ActivityCompleted(result=result))
+            result = cls._payload(event, 'result', related)
+            return event_with_result(LazyActivityCompleted(result=result))
         elif event_type == 'ActivityTaskFailed':
             reason = attributes.get('reason', None)
             details = attributes.get('details', None)
@@ -108,8 +166,7 @@ class AmazonSWFProcess(Process):
         }
         
         if event_type == 'ChildWorkflowExecutionCompleted':
-            json_res = json.loads(attributes['result']) if 'result' in attributes.keys() else None
-            result = ProcessCompleted(result=json_res)
+            result = LazyProcessCompleted(result=cls._payload(event, 'result', related))
         elif event_type == 'ChildWorkflowExecutionCanceled':
             details = attributes.get('details', None)
             result = ProcessCanceled(details=details)
@@ -127,13 +184,10 @@ class AmazonSWFProcess(Process):
         event_type = event['eventType']
         attributes = cls._attributes(event)
         
-        try:
-            data = json.loads(attributes['input']) if 'input' in attributes.keys() else None
-        except:
-            data = attributes.get('input', None)
+        data = cls._payload(event, 'input', related, strict=False)
         name = attributes['signalName']
         
-        return (event_id, SignalEvent(datetime=event_dt, signal=Signal(name=name, data=data)))
+        return (event_id, SignalEvent(datetime=event_dt, signal=LazySignal(name=name, data=data)))
 
     @classmethod
     def _timer_event(cls, event, related):
@@ -141,72 +195,344 @@ class AmazonSWFProcess(Process):
         event_dt = datetime.fromtimestamp(event['eventTimestamp'])
         attributes = cls._attributes(event)
 
-        started_by = filter(lambda x: x['eventId'] == attributes['startedEventId'], related)[0]
+        started_by = cls._related_event(related, attributes['startedEventId'])
         started_attrs = started_by['timerStartedEventAttributes']
-        timer = Timer(delay=int(started_attrs['startToFireTimeout']), data=json.loads(started_attrs['control']))
+        if cls._is_continuation_timer(started_attrs):
+            return None
+
+        timer = LazyTimer(delay=int(started_attrs['startToFireTimeout']), data=cls._payload(started_by, 'control', related))
         return (event_id, TimerEvent(datetime=event_dt, timer=timer))
 
     @classmethod
-    def event_from_description(cls, description, related=[]):
-        event_type = description['eventType']
-        if event_type == 'WorkflowExecutionStarted':
-            dt = datetime.fromtimestamp(description['eventTimestamp'])
-            return (description['eventId'], ProcessStartedEvent(datetime=dt))
-        elif event_type == 'DecisionTaskStarted':
-            dt = datetime.fromtimestamp(description['eventTimestamp'])
-            return (description['eventId'], DecisionStartedEvent(datetime=dt))
-        elif event_type in ['ActivityTaskScheduled','StartChildWorkflowExecutionInitiated','TimerStarted']:
-            return cls._decision_event(description, related)
-        elif event_type.startswith('ActivityTask') and not event_type == 'ActivityTaskScheduled':
-            return cls._activity_event(description, related)
-        elif event_type == 'WorkflowExecutionSignaled':
-            return cls._signal_event(description, related)
-        elif event_type.startswith('ChildWorkflowExecution'):
-            return cls._child_process_event(description, related)
-        elif event_type == 'TimerFired':
-            return cls._timer_event(description, related)
-        else:
+    def _process_started_event(cls, event, related):
+        dt = datetime.fromtimestamp(event['eventTimestamp'])
+        return (event['eventId'], ProcessStartedEvent(datetime=dt))
+
+    @classmethod
+    def _decision_started_event(cls, event, related):
+        dt = datetime.fromtimestamp(event['eventTimestamp'])
+        return (event['eventId'], DecisionStartedEvent(datetime=dt))
+
+    # maps SWF event types to the name of the classmethod that parses them
+    _event_handlers = {
+        'WorkflowExecutionStarted': '_process_started_event',
+        'DecisionTaskStarted': '_decision_started_event',
+        'ActivityTaskScheduled': '_decision_event',
+        'StartChildWorkflowExecutionInitiated': '_decision_event',
+        'TimerStarted': '_decision_event',
+        'ActivityTaskStarted': '_activity_event',
+        'ActivityTaskCompleted': '_activity_event',
+        'ActivityTaskFailed': '_activity_event',
+        'ActivityTaskCanceled': '_activity_event',
+        'ActivityTaskTimedOut': '_activity_event',
+        'WorkflowExecutionSignaled': '_signal_event',
+        'ChildWorkflowExecutionCompleted': '_child_process_event',
+        'ChildWorkflowExecutionCanceled': '_child_process_event',
+        'ChildWorkflowExecutionTimedOut': '_child_process_event',
+        'TimerFired': '_timer_event',
+    }
+
+    @classmethod
+    def event_from_description(cls, description, related={}):
+        handler = cls._event_handlers.get(description['eventType'], None)
+        if not handler:
             return None
 
+        # related should be indexed by eventId, but accept a plain list of event descriptions too
+        if not isinstance(related, dict):
+            related = cls._index(related)
+
+        return getattr(cls, handler)(description, related)
+
     @classmethod
-    def from_description(cls, description):
+    def from_description(cls, description, history=None):
         execution_desc = description.get('workflowExecution', None) or description.get('execution', None)
         if not execution_desc:
             return None
 
         pid = cls.pid_from_description(execution_desc)
-
         workflow = description.get('workflowType', {}).get('name', None)
-        tags = description.get('tagList', [])
-
-        events = []
-        event_descriptions = description.get('events', [])
-        
-        for event_description in event_descriptions:
-            start_attrs = event_description.get('workflowExecutionStartedEventAttributes', None)
-            if start_attrs:
-                try:
-                    input = json.loads(start_attrs['input'])
-                except:
-                    input = start_attrs.get('input', None)
-                tags = start_attrs['tagList']
-                
-                parent = None
-                parent_wfe = start_attrs.get('parentWorkflowExecution', None)
-                if parent_wfe:
-                    parent = cls.pid_from_description(parent_wfe)
 
+        if isinstance(history, AmazonSWFLazyHistory):
+            # events are only fetched and parsed once the history is read
+            tags = description.get('tagList', LAZY)
+            return AmazonSWFProcess(id=pid, workflow=workflow, input=LAZY, tags=tags, history=history, parent=LAZY)
 
-            event = cls.event_from_description(event_description, related=event_descriptions)
-            if event:
-                events.append(event)
+        # a previously parsed history only needs to parse the events it has not seen yet
+        history = history or AmazonSWFHistory()
+        history.extend(description.get('events', []))
 
-        # events is [(order, event)]. history is events sorted by logical order
-        history = [event for (log_order, event) in sorted(events, key=lambda (log_order, event): int(log_order))]
-        return AmazonSWFProcess(id=pid, workflow=workflow, input=input, tags=tags, history=history, parent=parent)
+        tags = history.tags if history.tags is not None else description.get('tagList', [])
+        return AmazonSWFProcess(id=pid, workflow=workflow, input=history.input, tags=tags, history=history.events, parent=history.parent)
 
     @classmethod
     def pid_from_description(cls, description):
         return '%s:%s' % (description['workflowId'], description['runId'])
-            
-    
\ No newline at end of file
+
+
+# event types are stored as an index into this list, new types are added as they are seen.
+# histories are parsed from several threads, so adding one is done under a lock.
+EVENT_TYPES = []
+EVENT_TYPE_CODES = {}
+EVENT_TYPES_LOCK = Lock()
+
+def event_type_code(event_type):
+    code = EVENT_TYPE_CODES.get(event_type, None)
+    if code is None:
+        with EVENT_TYPES_LOCK:
+            code = EVENT_TYPE_CODES.get(event_type, None)
+            if code is None:
+                EVENT_TYPES.append(event_type)
+                code = EVENT_TYPE_CODES[event_type] = len(EVENT_TYPES) - 1
+    return code
+
+class EventIndex(dict):
+    # events by eventId, along with the codec and memoized payloads used when parsing them
+    def __init__(self, events=(), codec=None):
+        super(EventIndex, self).__init__(events)
+        self.codec = codec or default_codec
+        self.payloads = {}
+
+class AmazonSWFEvent(object):
+    # Compact stand-in for an event description, keeping only the event's own attributes.
+    # It can be read like the description it was made from, so it parses the same way.
+    # parsed holds the (order, event) it parses into once it's been read, () if it parses into nothing.
+    __slots__ = ('event_id', 'type_code', 'timestamp', 'order', 'attributes', 'parsed')
+
+    def __init__(self, description, attributes):
+        self.event_id = description['eventId']
+        self.type_code = event_type_code(description['eventType'])
+        self.timestamp = float(description['eventTimestamp'])
+        self.order = self.event_id
+        self.attributes = attributes
+        self.parsed = None
+
+    @property
+    def event_type(self):
+        return EVENT_TYPES[self.type_code]
+
+    def get(self, key, default=None):
+        if key == 'eventId':
+            return self.event_id
+        elif key == 'eventType':
+            return self.event_type
+        elif key == 'eventTimestamp':
+            return self.timestamp
+        elif key == attributes_key(self.event_type):
+            return self.attributes
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+def attributes_key(event_type):
+    return event_type[0].lower() + event_type[1:] + 'EventAttributes'
+
+
+class AmazonSWFHistory(object):
+    CLOSE_EVENT_TYPES = [
+        'WorkflowExecutionCompleted',
+        'WorkflowExecutionFailed',
+        'WorkflowExecutionCanceled',
+        'WorkflowExecutionTerminated',
+        'WorkflowExecutionTimedOut',
+        'WorkflowExecutionContinuedAsNew'
+    ]
+
+    def __init__(self, codec=None):
+        self.tags = None
+        self.parent = None
+        self.closed = False
+        self.last_event_id = 0
+
+        self._input = None
+        self._related = EventIndex(codec=codec)
+        self._events = []
+        self._sorted = True
+        self._parsed = []
+
+        # continuation timers that fired after the last completed decision task started, as
+        # (TimerFired eventId, TimerStarted eventId, control)
+        self._continuations = []
+
+    def extend(self, event_descriptions):
+        for event_description in event_descriptions:
+            event_id = event_description['eventId']
+            if event_id <= self.last_event_id:
+                continue
+
+            self.last_event_id = event_id
+            event_type = event_description['eventType']
+            attributes = event_description.get(attributes_key(event_type), {})
+
+            if event_type == 'WorkflowExecutionStarted':
+                self._input = attributes.get('input', None)
+                self.tags = attributes['tagList']
+
+                parent_wfe = attributes.get('parentWorkflowExecution', None)
+                if parent_wfe:
+                    self.parent = AmazonSWFProcess.pid_from_description(parent_wfe)
+
+                # everything of use has been taken out of these
+                attributes = {}
+
+            elif event_type == 'DecisionTaskCompleted':
+                # continuation timers that fired before it started were handled by that decision task
+                started_event_id = attributes['startedEventId']
+                self._continuations = [c for c in self._continuations if c[0] > started_event_id]
+
+            elif event_type == 'TimerFired':
+                started = self._related.get(attributes['startedEventId'], None)
+                if started is not None and AmazonSWFProcess._is_continuation_timer(started.attributes):
+                    self._continuations.append((event_id, started.event_id, started.attributes.get('control', None)))
+
+            elif event_type in self.CLOSE_EVENT_TYPES:
+                self.closed = True
+
+            # only keep events that are parsed, or that are referred to by events that are parsed
+            is_parsed = event_type in AmazonSWFProcess._event_handlers
+            if not is_parsed and not event_type in AmazonSWFProcess.RELATED_EVENT_TYPES:
+                continue
+
+            event = AmazonSWFEvent(event_description, attributes)
+            if event_type in AmazonSWFProcess.RELATED_EVENT_TYPES:
+                self._related[event_id] = event
+
+            if is_parsed:
+                event.order = AmazonSWFProcess.event_order(event, self._related)
+                self._sorted = self._sorted and (not self._events or self._events[-1].order <= event.order)
+                self._events.append(event)
+                self._parsed = None
+
+    def release(self):
+        # drops the events built from the compact records, along with the payloads they decoded,
+        # so a history that's kept around between decision tasks takes up no more than its records
+        for event in self._events:
+            event.parsed = None
+        self._parsed = None
+        self._related.payloads = {}
+
+    @property
+    def input(self):
+        return Payload(self._input, codec=self._related.codec, strict=False).value() if self._input else None
+
+    @property
+    def continuations(self):
+        # controls of continuation timers that are still to be handled, in the order they were started
+        return [control for (fired, started, control) in sorted(self._continuations, key=lambda c: c[1])]
+
+    @property
+    def events(self):
+        # history is events sorted by logical order. event objects are only created when the
+        # history is read, and are kept, so later reads only create those of events added since
+        if self._parsed is None:
+            if not self._sorted:
+                self._events.sort(key=lambda event: event.order)
+                self._sorted = True
+
+            for event in self._events:
+                if event.parsed is None:
+                    event.parsed = AmazonSWFProcess.event_from_description(event, related=self._related) or ()
+            self._parsed = [event.parsed[1] for event in self._events if event.parsed]
+
+        return list(self._parsed)
+
+
+def unseen_events(pages, last_event_id):
+    # pages iterates over lists of event descriptions from newest to oldest, and is only read
+    # as far as it holds events past last_event_id. returns those events from oldest to newest.
+    unseen = []
+    for page in pages:
+        unseen += [ev for ev in page if ev['eventId'] > last_event_id]
+        if page and page[-1]['eventId'] <= last_event_id:
+            # reached events that were already parsed, no need to go further back
+            break
+
+    unseen.reverse()
+    return unseen
+
+class AmazonSWFLazyHistory(object):
+    def __init__(self, history, pages, on_read=None, on_parsed=None):
+        # history holds the events that are already known, pages iterates over
+        # lists of event descriptions from newest to oldest. on_read is called with
+        # the history and the event descriptions that were new to it, once it's read,
+        # and on_parsed with the seconds spent parsing them (not fetching them).
+        self._history = history
+        self._pages = pages
+        self._on_read = on_read
+        self._on_parsed = on_parsed
+        self._events = None
+        self._lock = Lock()
+
+    def _read(self):
+        with self._lock:
+            if self._events is None:
+                unseen = unseen_events(self._pages, self._history.last_event_id)
+                started = time.time()
+                self._history.extend(unseen)
+                self._events = self._history.events
+                self._pages = None
+
+                if self._on_parsed:
+                    self._on_parsed(time.time() - started)
+
+                if self._on_read:
+                    self._on_read(self._history, unseen)
+
+        return self._events
+
+    @property
+    def input(self):
+        self._read()
+        return self._history.input
+
+    @property
+    def tags(self):
+        self._read()
+        return self._history.tags if self._history.tags is not None else []
+
+    @property
+    def parent(self):
+        self._read()
+        return self._history.parent
+
+    @property
+    def continuations(self):
+        self._read()
+        return self._history.continuations
+
+    def __nonzero__(self):
+        # every execution history holds at least its start event
+        return True
+
+    def __len__(self):
+        return len(self._read())
+
+    def __iter__(self):
+        return iter(self._read())
+
+    def __getitem__(self, key):
+        return self._read()[key]
+
+    def __add__(self, other):
+        return self._read() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self._read()
+
+    def __eq__(self, other):
+        return self._read() == (other._read() if isinstance(other, AmazonSWFLazyHistory) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._read())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._read(), name)
@@ -0,0 +1,45 @@
+import os
+import json
+import tempfile
+from threading import Lock
+
+class RegistrationCache(object):
+    # Set of (kind, name) of types known to be registered in a domain. With a path, the set
+    # is shared through a json file keyed by domain, so workers can skip the lookups at startup.
+
+    def __init__(self, domain, path=None):
+        self.domain = domain
+        self.path = path
+        self._registered = set()
+        self._lock = Lock()
+
+        if path:
+            self._registered.update(self._read().get(domain, []))
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return dict((domain, set(tuple(t) for t in types)) for (domain, types) in json.load(f).items())
+        except (IOError, ValueError):
+            return {}
+
+    def __contains__(self, key):
+        return key in self._registered
+
+    def add(self, kind, name):
+        with self._lock:
+            self._registered.add((kind, name))
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self._lock:
+            # merge with what other workers saved in the meantime, and replace the file atomically
+            registered = self._read()
+            registered[self.domain] = registered.get(self.domain, set()) | self._registered
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict((domain, sorted(types)) for (domain, types) in registered.items()), f)
+            os.rename(tmp_path, self.path)
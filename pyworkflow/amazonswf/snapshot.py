@@ -0,0 +1,154 @@
+import sys
+import time
+import zlib
+import marshal
+import sqlite3
+import argparse
+import threading
+
+from contextlib import contextmanager
+from process import AmazonSWFProcess, AmazonSWFHistory
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (pid TEXT PRIMARY KEY, last_event_id INTEGER NOT NULL, used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS runs_used ON runs (used);
+CREATE TABLE IF NOT EXISTS chunks (pid TEXT NOT NULL, first_event_id INTEGER NOT NULL, size INTEGER NOT NULL, data BLOB NOT NULL,
+    PRIMARY KEY (pid, first_event_id));
+'''
+
+def encode_events(events):
+    # marshal is compact and fast, but specific to the python version snapshots are written with
+    return zlib.compress(marshal.dumps(events))
+
+def decode_events(data):
+    return marshal.loads(zlib.decompress(data))
+
+class SnapshotStore(object):
+    # Event descriptions of runs, kept in a sqlite database at path so that they survive restarts
+    # and are shared between worker processes on a host. Events of a run are appended in
+    # compressed chunks as they come in. Once the chunks take up more than max_size bytes,
+    # runs that were least recently used are evicted.
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite connections can't be shared between threads, so every thread gets its own.
+        # statements commit on their own, unless they run in a _transaction.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        # takes the write lock up front, so what's read in the transaction can't be changed
+        # by other threads or processes before it's written
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def events(self, pid):
+        # all events of the run that were stored, or None
+        db = self._db()
+        chunks = db.execute('SELECT data FROM chunks WHERE pid = ? ORDER BY first_event_id', (pid,)).fetchall()
+        if not chunks:
+            return None
+        db.execute('UPDATE runs SET used = ? WHERE pid = ?', (time.time(), pid))
+
+        events = []
+        for (data,) in chunks:
+            events += decode_events(str(data))
+        return events
+
+    def append(self, pid, events):
+        # events need to follow up on the events that were stored, returns False if they don't
+        with self._transaction() as db:
+            row = db.execute('SELECT last_event_id FROM runs WHERE pid = ?', (pid,)).fetchone()
+            last_event_id = row[0] if row else 0
+
+            events = [event for event in events if event['eventId'] > last_event_id]
+            if not events:
+                return True
+            if events[0]['eventId'] != last_event_id + 1:
+                return False
+
+            data = encode_events(events)
+            db.execute('INSERT INTO chunks (pid, first_event_id, size, data) VALUES (?, ?, ?, ?)',
+                (pid, events[0]['eventId'], len(data), sqlite3.Binary(data)))
+            db.execute('INSERT OR REPLACE INTO runs (pid, last_event_id, used) VALUES (?, ?, ?)',
+                (pid, events[-1]['eventId'], time.time()))
+
+            self._evict(db)
+        return True
+
+    def _evict(self, db):
+        size = db.execute('SELECT SUM(size) FROM chunks').fetchone()[0] or 0
+        if size <= self.max_size:
+            return
+
+        # evict down to 90%, so that not every append has to evict
+        for (pid,) in db.execute('SELECT pid FROM runs ORDER BY used').fetchall():
+            size -= db.execute('SELECT SUM(size) FROM chunks WHERE pid = ?', (pid,)).fetchone()[0] or 0
+            self._delete(db, pid)
+            if size <= self.max_size * 0.9:
+                break
+
+    def _delete(self, db, pid):
+        db.execute('DELETE FROM chunks WHERE pid = ?', (pid,))
+        db.execute('DELETE FROM runs WHERE pid = ?', (pid,))
+
+    def evict(self, pid):
+        with self._transaction() as db:
+            self._delete(db, pid)
+
+    def pids(self):
+        return [pid for (pid,) in self._db().execute('SELECT pid FROM runs ORDER BY used DESC')]
+
+def replay(store, pids=None, codec=None):
+    # parses stored histories, without SWF, into AmazonSWFProcess objects
+    for pid in pids or store.pids():
+        events = store.events(pid)
+        if not events:
+            continue
+
+        workflow_id, run_id = pid.split(':')
+        history = AmazonSWFHistory(codec=codec)
+        workflow_type = events[0].get('workflowExecutionStartedEventAttributes', {}).get('workflowType', {})
+        yield AmazonSWFProcess.from_description({
+            'workflowExecution': {'workflowId': workflow_id, 'runId': run_id},
+            'workflowType': workflow_type,
+            'events': events
+        }, history=history)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay histories from a snapshot store')
+    parser.add_argument('path', help='snapshot store database')
+    parser.add_argument('pids', nargs='*', metavar='PID', help='runs to replay as workflow_id:run_id (default: all)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the events of every run')
+    args = parser.parse_args(argv)
+
+    store = SnapshotStore(args.path)
+    started = time.time()
+    count = 0
+    for process in replay(store, args.pids):
+        count += 1
+        print '%s %s %d events' % (process.id, process.workflow, len(process.history))
+        if args.verbose:
+            for event in process.history:
+                print '  %r' % event
+
+    print '%d runs replayed in %.3fs' % (count, time.time() - started)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import os
+import errno
+import hashlib
+import tempfile
+
+class PayloadStore(object):
+    # Keeps payloads that are too large to go through SWF. put returns the key the payload
+    # can be read back with.
+
+    def put(self, data):
+        raise NotImplementedError()
+
+    def get(self, key):
+        raise NotImplementedError()
+
+class FileSystemPayloadStore(PayloadStore):
+    # Content-addressed store in a local directory, so the same payload is only written once
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def put(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        key = hashlib.sha1(data).hexdigest()
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # write under a temporary name, so readers never see a partial payload
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        return key
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read().decode('utf-8')
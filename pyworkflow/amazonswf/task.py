@@ -1,27 +1,29 @@
-import json
-
-from pyworkflow.activity import ActivityExecution
 from pyworkflow.task import DecisionTask, ActivityTask
 
 from process import AmazonSWFProcess
+from payload import Payload, LazyActivityExecution
 
-def decision_task_from_description(description):
+def decision_task_from_description(description, history=None):
     token = description.get('taskToken', None)
     if not token:
         return None
 
-    process = AmazonSWFProcess.from_description(description)
-    return DecisionTask(process, context={'token': token})
+    process = AmazonSWFProcess.from_description(description, history=history)
+    context = {'token': token}
+    if history is not None:
+        # the backend reads decisions that are still to be sent from the history
+        context['history'] = history
+    return DecisionTask(process, context=context)
 
-def activity_task_from_description(description):
+def activity_task_from_description(description, codec=None):
     token = description.get('taskToken', None)
     if not token:
         return None
 
     activity_id = description['activityId']
     activity = description['activityType']['name']
-    input = json.loads(description.get('input')) if description.get('input', None) else None
-    activity_execution = ActivityExecution(activity=activity, id=activity_id, input=input)
+    input = Payload(description['input'], codec=codec) if description.get('input', None) else None
+    activity_execution = LazyActivityExecution(activity=activity, id=activity_id, input=input)
 
     pid = AmazonSWFProcess.pid_from_description(description['workflowExecution'])
 
@@ -5,29 +5,61 @@ AMAZON_SWF_REGION = 'us-east-1'
 
 try:
     from test_settings import *
-except:
-    raise Exception('Please supply test_settings.py with configuration flags')
+    HAS_SETTINGS = True
+except ImportError:
+    HAS_SETTINGS = False
 
+import os
+import json
+import time
+import signal
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
+from threading import Thread, Event, Lock
 from boto import config
 
 from pyworkflow.defaults import Defaults
+from pyworkflow.process import Process
+from pyworkflow.decision import ScheduleActivity, CancelActivity, CompleteProcess, CancelProcess, StartChildProcess, Timer
+from pyworkflow.activity import ActivityCompleted, ActivityFailed
+from pyworkflow.events import ActivityEvent
 from pyworkflow.test import WorkflowBackendTestCase
 
-from backend import AmazonSWFBackend
+from backend import AmazonSWFBackend, AmazonSWFConfiguration
+from decision import AmazonSWFDecision
+from local import LocalSWF, fault
+from process import AmazonSWFProcess, AmazonSWFHistory, EVENT_TYPES, event_type_code, unseen_events
+from parallel import parallel_imap
+from codec import default_codec, CompressingCodec, OffloadingCodec
+from store import FileSystemPayloadStore
+from cache import HistoryCache
+from registration import RegistrationCache
+from connection import ConnectionPool, PooledLayer1
+from throttle import TokenBucket, RateLimiter, RetryPolicy
+from instrumentation import Aggregator, Histogram
+from snapshot import SnapshotStore, replay
+from worker import ActivityWorker, DecisionWorker, BufferedTask
+from asynchronous import AsyncAmazonSWFBackend
+from launcher import Supervisor
+from heartbeat import HeartbeatScheduler
+from pipeline import DecisionPipeline
+from admission import Admission
+from benchmark import HistoryBuilder, synthetic_history
 
 import logging
 logging.getLogger('boto').setLevel(logging.CRITICAL)
 
+@unittest.skipUnless(HAS_SETTINGS, 'Please supply test_settings.py with configuration flags')
 class AmazonSWFBackendTestCase(WorkflowBackendTestCase):
     def setUp(self):
         super(AmazonSWFBackendTestCase, self).setUp()
 
         self.backends = []
         backend = self.construct_backend()
-        for p in backend.processes():
-            backend.cancel_process(p)
+        backend.cancel_processes(backend.processes(with_history=False))
 
         self.is_external = True
 
@@ -55,6 +87,7 @@ class AmazonSWFBackendTestCase(WorkflowBackendTestCase):
         self.subtest_timer()
     
 
+@unittest.skipUnless(HAS_SETTINGS, 'Please supply test_settings.py with configuration flags')
 class AmazonSWFBackendThreadTestCase(WorkflowBackendTestCase):
     def setUp(self):
         super(AmazonSWFBackendThreadTestCase, self).setUp()
@@ -72,13 +105,13 @@ class AmazonSWFBackendThreadTestCase(WorkflowBackendTestCase):
 
         self.backends = []
         backend = self.construct_backend()
-        for p in backend.processes():
-            backend.cancel_process(p)
+        backend.cancel_processes(backend.processes(with_history=False))
 
     def tearDown(self):
         for b in self.backends:
             # trick the backend into retrying connections that will fail
-            b._swf.host = 'localhost'
+            for connection in b._swf.connections():
+                connection.host = 'localhost'
             b._swf.close()
         
         config.set('Boto', 'http_socket_timeout', '70')
@@ -92,4 +125,907 @@ class AmazonSWFBackendThreadTestCase(WorkflowBackendTestCase):
         return backend
 
     def test_threads(self):
-        self.subtest_threads()
\ No newline at end of file
+        self.subtest_threads()
+
+
+class AmazonSWFBackendLocalTestCase(WorkflowBackendTestCase):
+    # runs against an in-memory LocalSWF, so doesn't need credentials
+    def setUp(self):
+        super(AmazonSWFBackendLocalTestCase, self).setUp()
+
+        self.swf = LocalSWF(page_size=10, poll_timeout=1)
+        self.is_external = True
+
+    def construct_backend(self):
+        return AmazonSWFBackend(None, None, domain='local', connection_factory=lambda: self.swf)
+
+    def test_basic(self):
+        self.subtest_basic()
+
+    def test_managed(self):
+        self.subtest_managed()
+
+    def test_timeouts(self):
+        self.subtest_timeouts()
+
+    def test_order(self):
+        self.subtest_order()
+
+    def test_timer(self):
+        self.subtest_timer()
+
+# handlers for workers with processes=True need to be importable
+
+def double(task):
+    return task.activity_execution.input * 2
+
+def slow_double(task):
+    time.sleep(0.1)
+    return double(task)
+
+def unpicklable(task):
+    return lambda: None
+
+def complete_with_input(task):
+    return [CompleteProcess(result=task.process.input)]
+
+def starting_target():
+    # a worker process that takes a while to start
+    time.sleep(30)
+
+class PlainCodec(object):
+    # passes payloads through as they are
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return data
+
+class LocalTestCase(unittest.TestCase):
+    # backend against a LocalSWF, for tests of the backend's own features
+    def setUp(self):
+        self.swf = LocalSWF(page_size=10, poll_timeout=0.2)
+        self.backend = self.construct_backend()
+        self.backend.register_workflow('workflow')
+        self.backend.register_activity('activity')
+
+    def construct_backend(self, **kwargs):
+        return AmazonSWFBackend(None, None, domain='local', connection_factory=lambda: self.swf, **kwargs)
+
+    def schedule(self, count, **kwargs):
+        # starts a process and schedules count activities with inputs 1 to count
+        pid = self.backend.start_process(Process(workflow='workflow'))
+        task = self.backend.poll_decision_task()
+        self.backend.complete_decision_task(task, [ScheduleActivity('activity', id='activity-%d' % i, input=i, **kwargs) for i in range(1, count + 1)])
+        return pid
+
+    def results(self, pid):
+        history = self.backend.process_by_id(pid).history
+        return [event.result for event in history if isinstance(event, ActivityEvent)]
+
+    def wait(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'timed out waiting')
+            time.sleep(0.05)
+
+    def temporary_path(self, name):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return os.path.join(path, name)
+
+    def event_types(self, history):
+        return [type(event) for event in history]
+
+class ProcessListingTestCase(LocalTestCase):
+    def test_filters(self):
+        self.backend.start_processes([Process(workflow='workflow', tags=['a']), Process(workflow='workflow', tags=['b'])])
+
+        self.assertEqual(len(list(self.backend.processes(with_history=False))), 2)
+        self.assertEqual(self.backend.count_processes(tag='a'), 1)
+        self.assertEqual(self.backend.count_processes(closed=True), 0)
+
+    def test_histories_in_order(self):
+        self.backend.start_processes([Process(workflow='workflow') for _ in range(12)])
+        listed = [process.id for process in self.backend.processes(with_history=False)]
+        self.assertEqual([process.id for process in self.backend.processes()], listed)
+
+    def test_bulk(self):
+        results = self.backend.start_processes([Process(workflow='workflow') for _ in range(3)])
+        self.assertTrue(all(result.error is None and result.result for result in results))
+
+        results = self.backend.cancel_processes([results[0].result, 'unknown:run'])
+        self.assertEqual([result.error is None for result in results], [True, False])
+
+    def test_exclusive_filters(self):
+        self.assertRaises(ValueError, self.backend.processes, workflow='workflow', tag='a')
+        self.assertRaises(ValueError, self.backend.processes, close_status='COMPLETED')
+        self.assertRaises(ValueError, self.backend.processes, closed=True, close_status='COMPLETED', workflow='workflow')
+        self.assertRaises(ValueError, self.backend.count_processes, closed=True, close_status='COMPLETED', tag='a')
+
+class LinearScan(dict):
+    # looks related events up by scanning all of them, the way histories were parsed before they were indexed
+    def __init__(self, events):
+        super(LinearScan, self).__init__()
+        self.events = events
+
+    def __getitem__(self, event_id):
+        return filter(lambda ev: ev['eventId'] == event_id, self.events)[0]
+
+def plain(value):
+    # events as (type, attributes), with payloads decoded and lazy types named like the ones they stand in for
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if hasattr(value, '__dict__'):
+        return (type(value).__name__.replace('Lazy', '', 1), dict((key, plain(getattr(value, key))) for key in value.__dict__))
+    return value
+
+class ParsingTestCase(unittest.TestCase):
+    def test_matches_linear_scan(self):
+        payload = default_codec.encode({'data': 1})
+        history = HistoryBuilder()
+        history.add('WorkflowExecutionStarted', input=payload, tagList=['a'], taskList={'name': 'decisions'},
+            workflowType={'name': 'workflow', 'version': '1.0'}, parentWorkflowExecution={'workflowId': 'parent', 'runId': 'run'})
+        completed = history.completed(*history.decision())
+
+        def schedule(completed):
+            return (history.add('ActivityTaskScheduled', activityId='retried', activityType={'name': 'activity', 'version': '1.0'}, input=payload, decisionTaskCompletedEventId=completed),
+                history.add('StartChildWorkflowExecutionInitiated', workflowId='child', workflowType={'name': 'child', 'version': '1.0'}, input=payload, tagList=[], decisionTaskCompletedEventId=completed),
+                history.add('TimerStarted', timerId='timer', startToFireTimeout='10', control=payload, decisionTaskCompletedEventId=completed))
+
+        # the activity and child run are retried under the same ids, with completions referring back out of order
+        first = schedule(completed)
+        scheduled, started = history.decision()
+        history.add('WorkflowExecutionSignaled', signalName='signal', input='not json')
+        second = schedule(history.completed(scheduled, started))
+
+        started = history.add('ActivityTaskStarted', scheduledEventId=second[0])
+        history.add('ActivityTaskStarted', scheduledEventId=first[0])
+        history.add('ActivityTaskCompleted', scheduledEventId=second[0], startedEventId=started, result=payload)
+        history.add('ActivityTaskFailed', scheduledEventId=first[0], startedEventId=started - 1, reason='failed', details='details')
+        for (i, initiated) in enumerate([second[1], first[1]]):
+            history.add('ChildWorkflowExecutionCompleted', initiatedEventId=initiated, result=payload,
+                workflowExecution={'workflowId': 'child', 'runId': 'run-%d' % i}, workflowType={'name': 'child', 'version': '1.0'})
+        history.add('TimerFired', timerId='timer', startedEventId=first[2])
+        history.add('WorkflowExecutionSignaled', signalName='signal', input=payload)
+        history.decision()
+
+        events = history.events
+        expected = sorted((AmazonSWFProcess.event_from_description(ev, related=LinearScan(events)) for ev in events
+            if AmazonSWFProcess.event_from_description(ev, related=LinearScan(events))), key=lambda (order, event): order)
+
+        process = AmazonSWFProcess.from_description({'workflowExecution': {'workflowId': 'workflow', 'runId': 'run'},
+            'workflowType': {'name': 'workflow', 'version': '1.0'}, 'events': events})
+        self.assertEqual(plain(process.history), plain([event for (order, event) in expected]))
+        self.assertEqual((process.id, process.workflow, process.input, process.tags, process.parent),
+            ('workflow:run', 'workflow', {'data': 1}, ['a'], 'parent:run'))
+
+class DecisionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = AmazonSWFConfiguration()
+        self.configure('10')
+        self.config.config_workflow('workflow', {'taskList': {'name': 'decisions'}, 'childPolicy': 'ABANDON',
+            'executionStartToCloseTimeout': '60', 'taskStartToCloseTimeout': '10'})
+
+    def configure(self, timeout):
+        self.config.config_activity('activity', {'taskList': {'name': 'activities'}, 'heartbeatTimeout': timeout,
+            'scheduleToStartTimeout': timeout, 'scheduleToCloseTimeout': timeout, 'startToCloseTimeout': timeout})
+
+    def attributes(self, decision):
+        return AmazonSWFDecision.descriptions([decision], self.config)[0]['scheduleActivityTaskDecisionAttributes']
+
+    def test_template_reuse(self):
+        self.assertTrue(self.config.activity_template('activity') is self.config.activity_template('activity'))
+        self.assertEqual(self.attributes(ScheduleActivity('activity', id=1))['startToCloseTimeout'], '10')
+
+        # descriptions get their own attributes, not the template
+        self.attributes(ScheduleActivity('activity', id=1))['startToCloseTimeout'] = '0'
+        self.assertEqual(self.config.activity_template('activity')['startToCloseTimeout'], '10')
+
+    def test_reconfigured(self):
+        template = self.config.activity_template('activity')
+        self.config.for_activity('activity', camelcase=False, prepend='defaultTask')
+        self.configure('20')
+
+        self.assertFalse(self.config.activity_template('activity') is template)
+        self.assertEqual(self.attributes(ScheduleActivity('activity', id=1))['startToCloseTimeout'], '20')
+        self.assertEqual(self.config.for_activity('activity', camelcase=False, prepend='defaultTask')['default_task_start_to_close_timeout'], '20')
+
+    def test_overrides(self):
+        attributes = self.attributes(ScheduleActivity('activity', id=1, category='other', input={'a': 1}))
+        self.assertEqual(attributes['taskList'], {'name': 'other'})
+        self.assertEqual(attributes['input'], default_codec.encode({'a': 1}))
+        self.assertEqual(self.config.activity_template('activity')['taskList'], {'name': 'activities'})
+
+    def test_batch_matches_single(self):
+        decisions = [ScheduleActivity('activity', id=1, input=1), ScheduleActivity('activity', id=2, category='other'),
+            CancelActivity(1), StartChildProcess(Process(workflow='workflow', input={'a': 1}, tags=['a'])),
+            Timer(10, data={'b': 2}), CompleteProcess(result=3), CancelProcess(details='details')]
+
+        def without_ids(description):
+            # child workflow ids and timer ids are generated per description
+            for attributes in description.values():
+                if isinstance(attributes, dict):
+                    attributes.pop('workflowId', None)
+                    attributes.pop('timerId', None)
+            return description
+
+        self.assertEqual([without_ids(description) for description in AmazonSWFDecision.descriptions(decisions, self.config)],
+            [without_ids(AmazonSWFDecision(decision, self.config).description) for decision in decisions])
+
+        # the same attributes as built before templates, from a fresh export of the configuration
+        expected = dict({'activityId': '1', 'activityType': {'name': 'activity', 'version': '1.0'}, 'control': None,
+            'input': default_codec.encode(1)}.items() + self.config.for_activity('activity').items())
+        self.assertEqual(self.attributes(decisions[0]), expected)
+
+class HistoryTestCase(unittest.TestCase):
+    def test_incremental(self):
+        events = synthetic_history(activities=30, timers=5, children=5, signals=5)
+        full = AmazonSWFHistory()
+        full.extend(events)
+
+        history = AmazonSWFHistory()
+        history.extend(events[:-20])
+        read = history.events
+        history.extend(events[-20:])
+
+        # events that were read before are kept, and new ones are merged in logical order
+        self.assertEqual([type(event) for event in history.events], [type(event) for event in full.events])
+        self.assertTrue(all(any(event is other for other in history.events) for event in read))
+
+    def test_unseen_events(self):
+        events = synthetic_history(activities=30, timers=5, children=5, signals=5)
+        newest_first = list(reversed(events))
+        read = []
+
+        def pages():
+            for i in range(0, len(events), 10):
+                read.append(i)
+                yield newest_first[i:i + 10]
+
+        unseen = unseen_events(pages(), len(events) - 25)
+        self.assertEqual(unseen, events[-25:])
+        # only pages up to the known events are read
+        self.assertEqual(len(read), 3)
+
+        full = AmazonSWFHistory()
+        full.extend(events)
+        history = AmazonSWFHistory()
+        history.extend(events[:-25])
+        history.extend(unseen)
+        self.assertEqual([type(event) for event in history.events], [type(event) for event in full.events])
+
+    def test_cache(self):
+        cache = HistoryCache(size=2)
+        histories = [AmazonSWFHistory() for _ in range(3)]
+        for (i, history) in enumerate(histories):
+            cache.checkin(str(i), history)
+
+        # least recently used are evicted, and histories are handed out once
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.checkout('0') is None)
+        self.assertTrue(cache.checkout('2') is histories[2])
+        self.assertTrue(cache.checkout('2') is None)
+
+        # closed runs aren't decided again
+        self.assertTrue(cache.checkout('1') is histories[1])
+        histories[1].closed = True
+        cache.checkin('1', histories[1])
+        self.assertEqual(len(cache), 0)
+
+    def test_parallel_imap(self):
+        def slow(i):
+            time.sleep(0.01 * (i % 3))
+            return i
+
+        self.assertEqual(list(parallel_imap(slow, range(50), width=8, window=4)), range(50))
+
+    def test_released_in_cache(self):
+        history = AmazonSWFHistory()
+        history.extend(synthetic_history(activities=10, timers=2, children=2, signals=2))
+        read = plain(history.events)
+        HistoryCache().checkin('pid', history)
+
+        # cached histories only keep their records, events and payloads are built again when read
+        self.assertEqual(history._related.payloads, {})
+        self.assertTrue(all(event.parsed is None for event in history._events))
+        self.assertEqual(plain(history.events), read)
+
+    def test_event_type_codes(self):
+        event_types = ['TestEventType%d' % i for i in range(100)]
+        codes = list(parallel_imap(event_type_code, event_types * 4, width=8))
+        self.assertEqual(len(set(codes)), 100)
+        self.assertEqual([EVENT_TYPES[code] for code in codes], event_types * 4)
+
+class CodecTestCase(unittest.TestCase):
+    def test_default(self):
+        self.assertTrue(default_codec.json is json)
+        value = {'float': 0.1, 'int': 2 ** 70, 'text': u'caf\xe9'}
+        self.assertEqual(default_codec.encode(value), json.dumps(value))
+        self.assertEqual(default_codec.decode(default_codec.encode(value)), value)
+
+    def test_compressing(self):
+        codec = CompressingCodec(threshold=100)
+        small, large = {'data': 'x'}, {'data': 'x' * 1000}
+        self.assertEqual(codec.encode(small), default_codec.encode(small))
+        self.assertTrue(codec.encode(large).startswith(CompressingCodec.MARKER))
+        self.assertEqual(codec.decode(codec.encode(large)), large)
+
+        # payloads written without compression, and incompressible ones, are left alone
+        self.assertEqual(codec.decode(default_codec.encode(large)), large)
+        noise = os.urandom(1000)
+        self.assertEqual(CompressingCodec(PlainCodec(), threshold=100).encode(noise), noise)
+
+    def test_offloading(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = FileSystemPayloadStore(path)
+        codec = OffloadingCodec(store, threshold=100)
+
+        large = {'data': u'caf\xe9' * 100}
+        data = codec.encode(large)
+        self.assertTrue(data.startswith(OffloadingCodec.MARKER))
+        self.assertEqual(codec.decode(data), large)
+
+        # the same payload is only stored once
+        self.assertEqual(codec.encode(large), data)
+        self.assertEqual(sum(len(files) for (_, _, files) in os.walk(path)), 1)
+
+class PayloadTestCase(LocalTestCase):
+    def test_offloaded_and_compressed(self):
+        backend = self.construct_backend(payload_store=FileSystemPayloadStore(self.temporary_path('payloads')),
+            offload_threshold=1000, compression_threshold=100)
+        backend.register_workflow('workflow')
+        backend.register_activity('activity')
+
+        backend.start_process(Process(workflow='workflow'))
+        inputs = ['x' * 500, os.urandom(3000).encode('base64')]
+        backend.complete_decision_task(backend.poll_decision_task(), [ScheduleActivity('activity', id='activity-%d' % i, input=value) for (i, value) in enumerate(inputs)])
+
+        sent = [self.swf.poll_for_activity_task('local', Defaults.ACTIVITY_CATEGORY)['input'] for _ in inputs]
+        self.assertTrue(sent[0].startswith(CompressingCodec.MARKER))
+        self.assertTrue(sent[1].startswith(OffloadingCodec.MARKER))
+
+        self.assertEqual([backend._codec.decode(data) for data in sent], inputs)
+
+class DecisionTaskTestCase(LocalTestCase):
+    def decide(self, backend, count=15):
+        # a decision task that schedules count activities, and the one that follows once
+        # they completed, which is returned
+        backend.register_workflow('workflow')
+        backend.register_activity('activity')
+        pid = backend.start_process(Process(workflow='workflow'))
+
+        first = backend.poll_decision_task()
+        list(first.process.history)
+        backend.complete_decision_task(first, [ScheduleActivity('activity', id='activity-%d' % i, input=i) for i in range(count)])
+        for _ in range(count):
+            task = backend.poll_activity_task()
+            backend.complete_activity_task(task, ActivityCompleted(result=task.activity_execution.input))
+
+        return (pid, first, backend.poll_decision_task())
+
+    def test_cached(self):
+        backend = self.construct_backend(history_cache_size=10)
+        pid, first, task = self.decide(backend)
+
+        # the history of the first task is extended with the new events
+        self.assertTrue(task.context['history'] is first.context['history'])
+        self.assertEqual(self.event_types(task.process.history), self.event_types(self.backend.process_history(pid).events))
+
+    def test_lazy(self):
+        instrumentation = Aggregator()
+        backend = self.construct_backend(lazy_history=True, instrumentation=instrumentation)
+        pid, first, task = self.decide(backend)
+
+        # history pages aren't fetched until the history is read
+        self.assertEqual(instrumentation.snapshot()['histograms']['decision_task.pages']['count'], 1)
+        self.assertEqual(self.event_types(task.process.history), self.event_types(self.backend.process_history(pid).events))
+
+    def test_lazy_cached(self):
+        backend = self.construct_backend(lazy_history=True, history_cache_size=10)
+        pid, first, task = self.decide(backend)
+        self.assertEqual(self.event_types(task.process.history), self.event_types(self.backend.process_history(pid).events))
+
+    def test_snapshot(self):
+        store = SnapshotStore(self.temporary_path('snapshots.db'))
+        pid, first, task = self.decide(self.construct_backend(snapshot_store=store))
+        list(task.process.history)
+
+        full = self.backend.process_history(pid)
+        self.assertEqual([event['eventId'] for event in store.events(pid)], range(1, full.last_event_id + 1))
+        self.assertEqual(self.event_types(next(replay(store, [pid])).history), self.event_types(full.events))
+
+        # a backend that starts over with the store only fetches new events, newest first
+        self.backend.signal_process(pid, 'signal')
+        instrumentation = Aggregator()
+        backend = self.construct_backend(snapshot_store=store, instrumentation=instrumentation)
+        history = backend.process_history(pid)
+        self.assertEqual(instrumentation.snapshot()['histograms']['history.pages']['max'], 1)
+        self.assertEqual(self.event_types(history.events), self.event_types(self.backend.process_history(pid).events))
+
+    def test_concurrent_snapshots(self):
+        store = SnapshotStore(self.temporary_path('snapshots.db'))
+        events = synthetic_history(activities=3)
+        start = Event()
+        errors = []
+
+        def append(pid):
+            start.wait()
+            try:
+                store.append(pid, events)
+            except Exception, e:
+                errors.append(e)
+
+        # several workers append the same events of a run at once
+        threads = [Thread(target=append, args=('run:%d' % (i / 4),)) for i in range(80)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(store.pids()), 20)
+        self.assertEqual(store.events('run:0'), events)
+
+    def test_failing_snapshots(self):
+        class FailingStore(SnapshotStore):
+            def append(self, pid, events):
+                raise sqlite3.OperationalError('database is locked')
+
+        # failing to write a snapshot doesn't fail the decision task
+        store = FailingStore(self.temporary_path('snapshots.db'))
+        pid, first, task = self.decide(self.construct_backend(snapshot_store=store))
+        self.assertEqual(self.event_types(task.process.history), self.event_types(self.backend.process_history(pid).events))
+
+class ConnectionTestCase(unittest.TestCase):
+    def test_pool_size(self):
+        created = []
+        pool = ConnectionPool(lambda: created.append(object()) or created[-1], size=2)
+        lock = Lock()
+        in_use = [0, 0]
+
+        def use(i):
+            with pool.connection():
+                with lock:
+                    in_use[0] += 1
+                    in_use[1] = max(in_use)
+                time.sleep(0.02)
+                with lock:
+                    in_use[0] -= 1
+
+        list(parallel_imap(use, range(10), width=5))
+        self.assertEqual(len(created), 2)
+        self.assertEqual(in_use[1], 2)
+
+    def test_retries(self):
+        calls = []
+
+        class Flaky(object):
+            def count_open_workflow_executions(self, domain):
+                calls.append(domain)
+                if len(calls) < 3:
+                    raise fault('ThrottlingException')
+                return {'count': 0}
+
+            def start_workflow_execution(self, domain):
+                calls.append(domain)
+                raise fault('InternalFailure', status=500)
+
+        swf = PooledLayer1(Flaky, limiter=RateLimiter({'default': 100}), retry=RetryPolicy(3, base_delay=0.01))
+        self.assertEqual(swf.count_open_workflow_executions('local'), {'count': 0})
+        self.assertEqual(len(calls), 3)
+
+        # calls that change state are only retried when they were throttled
+        del calls[:]
+        self.assertRaises(Exception, swf.start_workflow_execution, 'local')
+        self.assertEqual(len(calls), 1)
+
+class ThrottleTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(10)
+        started = time.time()
+        for _ in range(10):
+            bucket.acquire()
+        self.assertTrue(time.time() - started < 0.05)
+        bucket.acquire()
+        self.assertTrue(time.time() - started >= 0.05)
+
+        # a burst of throttled calls halves the rate once, calls that go through grow it
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 5)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 5.2)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter({'default': 2, 'poll_for_activity_task': 5})
+        self.assertEqual(limiter.bucket('start_workflow_execution').rate, 2)
+        self.assertEqual(limiter.bucket('poll_for_activity_task').rate, 5)
+        self.assertTrue(limiter.bucket('poll_for_activity_task') is limiter.bucket('poll_for_activity_task'))
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(max_retries=2, base_delay=0.1)
+        self.assertTrue(policy.should_retry('start_workflow_execution', 0, True))
+        self.assertFalse(policy.should_retry('start_workflow_execution', 0, False))
+        self.assertTrue(policy.should_retry('describe_workflow_execution', 1, False))
+        self.assertFalse(policy.should_retry('describe_workflow_execution', 2, True))
+        self.assertTrue(all(0 <= policy.delay(3) <= 0.8 for _ in range(100)))
+
+class RegistrationTestCase(LocalTestCase):
+    def test_cache_file(self):
+        path = self.temporary_path('registered.json')
+        swf = self.swf
+        described = []
+
+        class Counting(object):
+            def __getattr__(self, name):
+                if name.startswith('describe_'):
+                    described.append(name)
+                return getattr(swf, name)
+
+        AmazonSWFBackend(None, None, domain='local', connection_factory=Counting, registration_cache=path).register_activity('activity')
+        self.assertEqual(len(described), 1)
+
+        # other workers sharing the file skip the lookup
+        AmazonSWFBackend(None, None, domain='local', connection_factory=Counting, registration_cache=path).register_activity('activity')
+        self.assertEqual(len(described), 1)
+        self.assertTrue(('activity', 'activity') in RegistrationCache('local', path))
+        self.assertFalse(('activity', 'activity') in RegistrationCache('other', path))
+
+    def test_register_all(self):
+        self.backend.register_all(workflows={'other': {}}, activities={'activity': {}, 'another': {}})
+        self.assertTrue(('workflow', 'other') in self.backend._registered)
+        self.assertEqual(sorted(self.backend._registered_types('activity')), ['activity', 'another'])
+
+class InstrumentationTestCase(LocalTestCase):
+    def test_backend(self):
+        instrumentation = Aggregator()
+        backend = self.construct_backend(instrumentation=instrumentation)
+        backend.register_workflow('workflow')
+        backend.start_process(Process(workflow='workflow'))
+        backend.poll_decision_task()
+        backend.poll_activity_task()
+
+        snapshot = instrumentation.snapshot(reset=True)
+        self.assertEqual(snapshot['counters']['decision_task.tasks'], 1)
+        self.assertEqual(snapshot['counters']['activity_task.empty_polls'], 1)
+        self.assertEqual(snapshot['histograms']['swf.poll_for_decision_task.latency']['count'], 1)
+        self.assertEqual(instrumentation.snapshot()['counters'], {})
+
+    def test_lazy_history(self):
+        instrumentation = Aggregator()
+        backend = self.construct_backend(instrumentation=instrumentation, lazy_history=True)
+        backend.register_workflow('workflow')
+        backend.start_process(Process(workflow='workflow', input='x' * 10000))
+        task = backend.poll_decision_task()
+        self.assertEqual(task.process.input, 'x' * 10000)
+
+        histograms = instrumentation.snapshot()['histograms']
+        self.assertEqual(histograms['decision_task.parse']['count'], 1)
+        # the input makes up most of the history
+        self.assertTrue(10000 < histograms['decision_task.bytes']['max'] < 12000)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.add(value)
+
+        # percentiles are within a bucket of the actual value
+        self.assertTrue(50 <= histogram.percentile(0.5) <= 50 * Histogram.BASE)
+        self.assertTrue(99 <= histogram.percentile(0.99) <= 100)
+        self.assertEqual(histogram.summary()['mean'], 50.5)
+
+class WorkerTestCase(LocalTestCase):
+    def run_worker(self, worker, condition):
+        worker.start()
+        try:
+            self.wait(condition)
+        finally:
+            worker.stop()
+        # every slot is given back
+        self.assertEqual(worker._slots._Semaphore__value, worker._slots._initial_value)
+
+    def test_activities(self):
+        pid = self.schedule(10)
+        self.run_worker(ActivityWorker(self.backend, double, size=3), lambda: len(self.results(pid)) == 10)
+        self.assertEqual(sorted(result.result for result in self.results(pid)), range(2, 21, 2))
+
+    def test_no_polls_after_stop(self):
+        pid = self.schedule(5)
+        handled = []
+
+        def handle(task):
+            handled.append(task)
+            time.sleep(0.3)
+            return double(task)
+
+        # the other pollers are waiting for the slot when the worker stops
+        worker = ActivityWorker(self.backend, handle, size=1, pollers=3)
+        worker.start()
+        self.wait(lambda: handled)
+        worker.stop()
+
+        self.assertEqual(len(handled), 1)
+        self.assertEqual(len(self.results(pid)), 1)
+
+    def test_processes(self):
+        pid = self.schedule(5)
+        self.run_worker(ActivityWorker(self.backend, double, size=2, processes=True), lambda: len(self.results(pid)) == 5)
+        self.assertEqual(sorted(result.result for result in self.results(pid)), range(2, 11, 2))
+
+    def test_unpicklable_result(self):
+        pid = self.schedule(3)
+        self.run_worker(ActivityWorker(self.backend, unpicklable, size=2, processes=True), lambda: len(self.results(pid)) == 3)
+        self.assertTrue(all(isinstance(result, ActivityFailed) for result in self.results(pid)))
+
+    def test_decisions_in_processes(self):
+        pid = self.backend.start_process(Process(workflow='workflow', input={'a': 1}))
+        self.run_worker(DecisionWorker(self.backend, complete_with_input, processes=True), lambda: self.backend.count_processes(closed=True) == 1)
+        self.assertEqual(self.swf.describe_workflow_execution('local', pid.split(':')[1], pid.split(':')[0])['executionInfo']['closeStatus'], 'COMPLETED')
+
+    def test_prefetch(self):
+        pid = self.schedule(8)
+        worker = ActivityWorker(self.backend, slow_double, size=2, prefetch=4)
+        self.run_worker(worker, lambda: len(self.results(pid)) == 8)
+        self.assertEqual(sorted(result.result for result in self.results(pid)), range(2, 17, 2))
+        self.assertEqual(worker.dropped, 0)
+
+    def test_prefetch_drains_on_stop(self):
+        pid = self.schedule(4)
+        worker = ActivityWorker(self.backend, slow_double, size=1, prefetch=2)
+        worker.start()
+        self.wait(lambda: worker._buffer)
+        worker.stop()
+
+        # buffered tasks are still handled, none are failed
+        self.assertTrue(len(self.results(pid)) >= 2)
+        self.assertFalse(any(isinstance(result, ActivityFailed) for result in self.results(pid)))
+        self.assertEqual(worker._slots._Semaphore__value, worker._slots._initial_value)
+
+    def test_prefetch_polls_ahead_while_in_time(self):
+        worker = ActivityWorker(self.backend, double, size=1, prefetch=4)
+        worker._running['token'] = time.time()
+        self.assertTrue(worker._can_poll())
+
+        # one ahead until it's known how long handlers take
+        worker._buffer.append(None)
+        self.assertFalse(worker._can_poll())
+
+        worker._admission.duration, worker._admission.timeout = 1, 10
+        self.assertTrue(worker._can_poll())
+        worker._admission.duration = 4
+        self.assertFalse(worker._can_poll())
+
+    def test_prefetch_drops_timed_out(self):
+        pid = self.schedule(1)
+        task = self.backend.poll_activity_task()
+        worker = ActivityWorker(self.backend, double, size=1, prefetch=1)
+
+        worker._slots.acquire()
+        worker._buffer.append(BufferedTask(task, time.time() - 1, None))
+        worker._dispatch()
+
+        # left to time out, rather than failed
+        self.assertEqual(worker.dropped, 1)
+        self.assertEqual(self.results(pid), [])
+        self.assertEqual(worker._slots._Semaphore__value, worker._slots._initial_value)
+
+class AsyncTestCase(LocalTestCase):
+    def test_polls_dont_hold_up_calls(self):
+        self.swf.poll_timeout = 2
+        backend = AsyncAmazonSWFBackend(self.backend, size=2, poll_size=2)
+        polls = [backend.poll_activity_task() for _ in range(4)]
+
+        started = time.time()
+        pid = backend.start_process(Process(workflow='workflow')).get(timeout=5)
+        self.assertTrue(time.time() - started < 1)
+
+        history = backend.process_history(pid).get(timeout=5)
+        self.assertEqual(history.last_event_id, 2)
+        self.assertEqual(sum(len(page) for page in self.backend.history_pages(pid, reverse_order=True)), 2)
+
+        self.assertEqual([poll.get(timeout=10) for poll in polls], [None] * 4)
+        backend.close()
+
+    def test_history_pages(self):
+        pid = self.schedule(12)
+        backend = AsyncAmazonSWFBackend(self.backend)
+
+        for reverse_order in [False, True]:
+            pages = list(backend.history_pages(pid, reverse_order=reverse_order))
+            self.assertTrue(len(pages) > 1)
+            self.assertEqual(pages, list(self.backend.history_pages(pid, reverse_order=reverse_order)))
+        backend.close()
+
+class SupervisorTestCase(unittest.TestCase):
+    def tearDown(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    def test_stop_while_starting(self):
+        supervisor = Supervisor([starting_target] * 2)
+        spawn = supervisor._spawn
+        signalling = []
+
+        def spawn_and_signal(target):
+            spawn(target)
+            if len(supervisor._children) == 2 and not signalling:
+                signalling.append(os.fork())
+            if signalling == [0]:
+                # SIGTERM the workers while they start, then the supervisor
+                time.sleep(0.5)
+                for pid in supervisor._children:
+                    os.kill(pid, signal.SIGTERM)
+                time.sleep(0.5)
+                os.kill(os.getppid(), signal.SIGTERM)
+                os._exit(0)
+        supervisor._spawn = spawn_and_signal
+
+        started = time.time()
+        supervisor.run()
+        self.assertTrue(time.time() - started < 10)
+
+class HeartbeatTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.scheduler = HeartbeatScheduler(lambda token, details: self.sent.append((token, details)), fraction=0.5)
+
+    def test_coalescing(self):
+        self.scheduler.track('token', 0.4)
+        self.assertTrue(self.scheduler.beat('token', 'first'))
+        self.assertTrue(self.scheduler.beat('token', 'second'))
+        self.assertFalse(self.scheduler.beat('other', 'details'))
+
+        time.sleep(0.3)
+        self.assertEqual(self.sent, [('token', 'second')])
+        self.scheduler.stop()
+
+    def test_stop(self):
+        self.scheduler.track('token', 60)
+        self.scheduler.beat('token', 'pending')
+        thread = self.scheduler._thread
+
+        self.scheduler.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.sent, [('token', 'pending')])
+
+        # tracking again starts a new thread
+        self.scheduler.track('other', 0.2)
+        time.sleep(0.2)
+        self.scheduler.stop()
+        self.assertTrue(('other', None) in self.sent)
+
+    def test_worker_stops_heartbeats(self):
+        swf = LocalSWF(poll_timeout=0.2)
+        backend = AmazonSWFBackend(None, None, domain='local', connection_factory=lambda: swf, auto_heartbeat=True)
+        backend.register_activity('activity', heartbeat_timeout=60)
+        backend._heartbeats.track('token', 60)
+
+        worker = ActivityWorker(backend, double)
+        worker.start()
+        worker.stop()
+        self.assertTrue(backend._heartbeats._thread is None)
+
+class AdmissionTestCase(unittest.TestCase):
+    def test_admits(self):
+        admission = Admission(width=2)
+        self.assertTrue(admission.admits(1, 0))
+        # one ahead until it's known how long handling takes
+        self.assertTrue(admission.admits(2, 0))
+        self.assertFalse(admission.admits(2, 1))
+
+        # the shortest timeout counts
+        self.assertEqual(admission.deadline(100, 10), 110)
+        self.assertEqual(admission.deadline(100, 30), 130)
+        self.assertEqual(admission.deadline(100, None), None)
+        self.assertEqual(admission.timeout, 10)
+
+        admission.finished(2)
+        admission.finished(4)
+        self.assertAlmostEqual(admission.duration, 2.4)
+        # a handler frees up, 6 waiting tasks go first, 2 at a time, then it takes 2.4 seconds itself
+        self.assertTrue(admission.admits(2, 4))
+        self.assertFalse(admission.admits(2, 6))
+
+class PipelineTestCase(LocalTestCase):
+    def test_deadlines(self):
+        # deciding takes long enough that polling 5 tasks ahead would have them time out
+        self.backend.register_workflow('workflow', decision_timeout=1)
+        self.backend.start_processes([Process(workflow='workflow') for _ in range(6)])
+
+        def decide(task):
+            time.sleep(0.3)
+            return [CompleteProcess()]
+
+        pipeline = DecisionPipeline(self.backend, decide, depth=5)
+        stop = Event()
+        thread = Thread(target=pipeline.run, args=(stop,))
+        thread.start()
+        try:
+            self.wait(lambda: self.backend.count_processes(closed=True) == 6)
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertEqual(pipeline.dropped, 0)
+        timed_out = [event for execution in self.swf._executions.values() for event in execution.events if event['eventType'] == 'DecisionTaskTimedOut']
+        self.assertEqual(timed_out, [])
+
+    def test_slow_decider(self):
+        # deciding takes more than half of the timeout, so there's no polling ahead, but every run is decided
+        self.backend.register_workflow('workflow', decision_timeout=2)
+        self.backend.start_processes([Process(workflow='workflow') for _ in range(3)])
+
+        def decide(task):
+            time.sleep(1.2)
+            return [CompleteProcess()]
+
+        pipeline = DecisionPipeline(self.backend, decide, depth=2)
+        stop = Event()
+        thread = Thread(target=pipeline.run, args=(stop,))
+        thread.start()
+        try:
+            self.wait(lambda: self.backend.count_processes(closed=True) == 3)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(pipeline.dropped, 0)
+
+    def test_received_before_paging(self):
+        pid = self.schedule(30)
+        for _ in range(30):
+            task = self.backend.poll_activity_task()
+            self.backend.complete_activity_task(task, ActivityCompleted(result=1))
+
+        # the deadline runs from the first page, not from when the whole history was fetched
+        self.swf.latency = 0.05
+        task = self.backend.poll_decision_task()
+        self.assertTrue(time.time() - task.context['received'] >= 0.2)
+
+    def test_drains_on_stop(self):
+        pid = self.backend.start_process(Process(workflow='workflow'))
+        stop = Event()
+
+        def decide(task):
+            stop.set()
+            return [CompleteProcess()]
+
+        DecisionPipeline(self.backend, decide).run(stop)
+        self.assertEqual(self.backend.count_processes(closed=True), 1)
+
+class SplitTestCase(LocalTestCase):
+    def fan_out(self, count, size, **kwargs):
+        backend = self.construct_backend(**kwargs)
+        backend.register_workflow('workflow')
+        backend.register_activity('activity')
+        pid = backend.start_process(Process(workflow='workflow'))
+
+        decisions = [ScheduleActivity('activity', id='activity-%d' % i, input='x' * size) for i in range(count)]
+        rounds = 0
+        while True:
+            task = backend.poll_decision_task()
+            if task is None:
+                break
+            backend.complete_decision_task(task, decisions)
+            decisions = []
+            rounds += 1
+
+        scheduled = [event for event in self.swf._executions[pid.split(':')[1]].events if event['eventType'] == 'ActivityTaskScheduled']
+        self.assertEqual(sorted(event['activityTaskScheduledEventAttributes']['activityId'] for event in scheduled),
+            sorted('activity-%d' % i for i in range(count)))
+        return rounds
+
+    def test_split(self):
+        self.assertEqual(self.fan_out(250, 10), 3)
+
+    def test_split_past_control_limit(self):
+        # 400 decisions of ~1 KB don't fit in one timer control
+        self.assertEqual(self.fan_out(400, 1000), 5)
+
+    def test_split_lazy(self):
+        self.assertEqual(self.fan_out(400, 1000, lazy_history=True), 5)
+
+    def test_split_cached(self):
+        self.assertEqual(self.fan_out(400, 1000, history_cache_size=10), 5)
@@ -0,0 +1,82 @@
+import time
+import random
+
+from threading import Lock
+
+class TokenBucket(object):
+    # Token bucket whose rate (tokens per second) adapts AIMD style: it grows additively with
+    # every call that goes through, and halves when a call is throttled.
+
+    def __init__(self, rate, min_rate=0.1, max_rate=None, increase=1.0):
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or 10 * self.rate
+        self.increase = increase
+
+        self._tokens = max(1.0, self.rate)
+        self._updated = time.time()
+        self._decreased = 0
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self._lock:
+            # grows by about increase per second when calls are made at the full rate
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def throttled(self):
+        with self._lock:
+            # a burst of throttled calls counts as a single signal to back off
+            now = time.time()
+            if now - self._decreased > 1:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._decreased = now
+
+class RateLimiter(object):
+    # A token bucket per API call. rates maps call names to initial rates, with 'default'
+    # for calls that aren't listed.
+
+    def __init__(self, rates):
+        self.rates = dict(rates)
+        self._buckets = {}
+        self._lock = Lock()
+
+    def bucket(self, name):
+        with self._lock:
+            bucket = self._buckets.get(name, None)
+            if bucket is None:
+                bucket = self._buckets[name] = TokenBucket(self.rates.get(name, self.rates.get('default', 10)))
+            return bucket
+
+class RetryPolicy(object):
+    # Retries throttled calls, which SWF rejected without processing, and calls that only read
+    # when they fail on SWF's side. Retries back off exponentially with full jitter.
+
+    IDEMPOTENT_PREFIXES = ('describe_', 'list_', 'count_', 'get_')
+
+    def __init__(self, max_retries=3, base_delay=0.1, max_delay=20):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, name, attempt, throttled):
+        if attempt >= self.max_retries:
+            return False
+        return throttled or name.startswith(self.IDEMPOTENT_PREFIXES)
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
@@ -0,0 +1,369 @@
+import os
+import copy
+import time
+import cPickle as pickle
+import socket
+import logging
+import traceback
+
+from threading import Thread, Event, Lock, Condition, BoundedSemaphore
+from collections import deque
+from multiprocessing.pool import Pool, ThreadPool
+
+from pyworkflow.defaults import Defaults
+from pyworkflow.task import DecisionTask
+from pyworkflow.activity import ActivityCompleted, ActivityCanceled, ActivityFailed
+
+from admission import Admission
+
+logger = logging.getLogger(__name__)
+
+def call_handler(handler, task):
+    # runs in the executor, so failures are returned rather than raised
+    try:
+        return (True, handler(task))
+    except Exception:
+        return (False, traceback.format_exc())
+
+def call_pickled(handler, data):
+    # runs in a worker process. the task and outcome go across pickled by hand, so that one
+    # that can't be pickled fails the task, rather than getting lost in the pool
+    try:
+        return pickle.dumps(call_handler(handler, pickle.loads(data)), pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return pickle.dumps((False, traceback.format_exc()), pickle.HIGHEST_PROTOCOL)
+
+class Worker(object):
+    # Keeps a number of long polls open per task list, and hands the tasks they return to a
+    # pool of size threads (or processes). Polling stops while the pool is saturated, so no
+    # more tasks are taken than can be started right away. With processes=True, the handler
+    # and what it returns need to be picklable. Tasks are sent to it with their payloads decoded.
+
+    DEFAULT_CATEGORY = None
+
+    def __init__(self, backend, handler, categories=None, pollers=2, size=4, processes=False, identity=None):
+        self.backend = backend
+        self.handler = handler
+        self.categories = categories or [self.DEFAULT_CATEGORY]
+        self.pollers = pollers
+        self.size = size
+        self.processes = processes
+        self.identity = identity or '%s-%d' % (socket.gethostname(), os.getpid())
+
+        self._slots = BoundedSemaphore(size)
+        self._stopping = Event()
+        self._threads = []
+        self._executor = None
+        self._completer = None
+
+    def poll(self, category):
+        raise NotImplementedError()
+
+    def complete(self, task, succeeded, result):
+        raise NotImplementedError()
+
+    def start(self):
+        self._stopping.clear()
+
+        if self.processes:
+            # fails right away if the handler can't be sent to the pool
+            pickle.dumps(self.handler, pickle.HIGHEST_PROTOCOL)
+
+            # handlers run in the process pool, responding is left to threads in this process
+            self._executor = Pool(self.size)
+            self._completer = ThreadPool(self.size)
+        else:
+            self._executor = ThreadPool(self.size)
+
+        for category in self.categories:
+            for i in range(self.pollers):
+                thread = Thread(target=self._poll_loop, args=(category,), name='%s-%s-%d' % (type(self).__name__, category, i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, wait=True):
+        # long polls that are in flight are allowed to finish, and the tasks they return are still handled
+        self._stopping.set()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            self._drain()
+
+            for pool in filter(None, [self._executor, self._completer]):
+                pool.close()
+                pool.join()
+
+    def run(self):
+        self.start()
+        try:
+            while any(thread.is_alive() for thread in self._threads):
+                self._stopping.wait(1)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _poll_loop(self, category):
+        while not self._stopping.is_set():
+            # back-pressure: only poll when there's room to run what comes back
+            self._slots.acquire()
+            if self._stopping.is_set():
+                # stopped while waiting for a slot
+                self._slots.release()
+                break
+
+            if not self._can_poll():
+                self._slots.release()
+                self._stopping.wait(0.1)
+                continue
+
+            try:
+                task = self.poll(category)
+            except Exception:
+                logger.exception('Polling %s failed', category)
+                self._slots.release()
+                self._stopping.wait(1)
+                continue
+
+            if task is None:
+                self._slots.release()
+            else:
+                self._submit(task)
+
+    def _can_poll(self):
+        # whether there's use in polling now, besides there being a slot free
+        return True
+
+    def _drain(self):
+        # called on stop, once polling stopped and before the pools are closed
+        pass
+
+    def _picklable(self, task):
+        # what's sent to handlers in the process pool for task
+        return task
+
+    def _submit(self, task):
+        if not self.processes:
+            self._executor.apply_async(self._run, (task,))
+            return
+
+        try:
+            data = pickle.dumps(self._picklable(task), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.exception('Pickling task failed')
+            self._finish(task, (False, traceback.format_exc()))
+            return
+
+        self._executor.apply_async(call_pickled, (self.handler, data),
+            callback=lambda outcome: self._completer.apply_async(self._finish_pickled, (task, outcome)))
+
+    def _run(self, task):
+        self._finish(task, call_handler(self.handler, task))
+
+    def _finish_pickled(self, task, data):
+        try:
+            outcome = pickle.loads(data)
+        except Exception:
+            outcome = (False, traceback.format_exc())
+        self._finish(task, outcome)
+
+    def _finish(self, task, outcome):
+        try:
+            self.complete(task, *outcome)
+        except Exception:
+            logger.exception('Completing task failed')
+        finally:
+            self._slots.release()
+
+class BufferedTask(object):
+    __slots__ = ('task', 'deadline', 'heartbeat_interval', 'heartbeat_due')
+
+    def __init__(self, task, deadline, heartbeat_interval):
+        self.task = task
+        self.deadline = deadline
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_due = time.time() + heartbeat_interval if heartbeat_interval else None
+
+    def heartbeat_stale(self, now):
+        # whether the task has waited long enough since its last heartbeat to need one before it's handled
+        return self.heartbeat_due is not None and self.heartbeat_due - now < self.heartbeat_interval / 2
+
+class ActivityWorker(Worker):
+    # handler is called with an ActivityTask, and returns an ActivityCompleted, ActivityCanceled,
+    # ActivityFailed or the plain result of the activity.
+    #
+    # With prefetch, up to that many tasks are polled ahead while all handlers are busy, as long
+    # as they'd be finished before their startToClose or scheduleToClose timeout. They wait in a
+    # buffer, where they are heartbeated, until a handler is free. Buffered tasks that timed out
+    # while waiting anyway are dropped (left to SWF to time out and retry), and counted in
+    # dropped. On stop, buffered tasks are still handled before the pools are closed.
+
+    DEFAULT_CATEGORY = Defaults.ACTIVITY_CATEGORY
+
+    def __init__(self, backend, handler, categories=None, pollers=2, size=4, processes=False, identity=None, prefetch=0):
+        super(ActivityWorker, self).__init__(backend, handler, categories, pollers, size, processes, identity)
+        self.prefetch = prefetch
+        self.dropped = 0
+
+        # polling goes on while there's room in the buffer
+        self._slots = BoundedSemaphore(size + prefetch)
+        self._buffer = deque()
+        self._running = {}
+        self._dispatching = 0
+        self._admission = Admission(size)
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._heartbeater = None
+
+    def poll(self, category):
+        return self.backend.poll_activity_task(category=category, identity=self.identity)
+
+    def start(self):
+        super(ActivityWorker, self).start()
+
+        if self.prefetch:
+            self._heartbeater = Thread(target=self._heartbeat_loop, name='%s-heartbeat' % type(self).__name__)
+            self._heartbeater.daemon = True
+            self._heartbeater.start()
+
+    def stop(self, wait=True):
+        super(ActivityWorker, self).stop(wait)
+        if wait:
+            if self._heartbeater:
+                self._heartbeater.join()
+                self._heartbeater = None
+            self.backend.stop_heartbeats()
+
+    def _can_poll(self):
+        # a task polled while all handlers are busy is buffered
+        with self._lock:
+            return not self.prefetch or self._admission.admits(len(self._running), len(self._buffer))
+
+    def _drain(self):
+        # buffered tasks are handled as handlers free up
+        with self._lock:
+            while self._buffer or self._dispatching:
+                self._changed.wait(0.1)
+
+    def _submit(self, task):
+        if not self.prefetch:
+            return super(ActivityWorker, self)._submit(task)
+
+        activity = task.activity_execution.activity
+        timeout = self.backend.activity_timeout(activity)
+        heartbeat_timeout = self.backend.heartbeat_timeout(activity)
+
+        with self._lock:
+            self._buffer.append(BufferedTask(task, self._admission.deadline(time.time(), timeout),
+                heartbeat_timeout / 2 if heartbeat_timeout else None))
+        self._dispatch()
+
+    def _dispatch(self):
+        dropped = []
+        started = []
+        with self._lock:
+            now = time.time()
+            # tasks that timed out while waiting can't be completed anymore
+            for buffered in list(self._buffer):
+                if buffered.deadline is not None and now >= buffered.deadline:
+                    self._buffer.remove(buffered)
+                    dropped.append(buffered)
+
+            while self._buffer and len(self._running) < self.size:
+                buffered = self._buffer.popleft()
+                self._running[buffered.task.context['token']] = now
+                started.append(buffered)
+
+            self._dispatching += len(started)
+            self.dropped += len(dropped)
+
+        for buffered in started:
+            # handlers get the whole heartbeat timeout, not what's left of it after waiting
+            if buffered.heartbeat_stale(time.time()):
+                self._heartbeat(buffered.task)
+            super(ActivityWorker, self)._submit(buffered.task)
+
+        for buffered in dropped:
+            self._drop(buffered.task)
+
+        if started or dropped:
+            with self._lock:
+                self._dispatching -= len(started)
+                self._changed.notify_all()
+
+    def _drop(self, task):
+        if self.backend.instrumentation is not None:
+            self.backend.instrumentation.count('activity_task.dropped')
+        logger.warning('Dropping activity task %s, it timed out while waiting', task.activity_execution.id)
+        self._slots.release()
+
+    def _finish(self, task, outcome):
+        super(ActivityWorker, self)._finish(task, outcome)
+        if not self.prefetch:
+            return
+
+        with self._lock:
+            started = self._running.pop(task.context['token'], None)
+            if started is not None:
+                self._admission.finished(time.time() - started)
+        self._dispatch()
+
+    def _heartbeat(self, task):
+        try:
+            self.backend.heartbeat_activity_task(task)
+        except Exception:
+            logger.exception('Heartbeating buffered task failed')
+
+    def _heartbeat_loop(self):
+        # runs until the worker stopped and its buffer is drained
+        while True:
+            with self._lock:
+                if self._stopping.is_set() and not self._buffer:
+                    return
+                self._changed.wait(1)
+
+                now = time.time()
+                due = [buffered for buffered in self._buffer if buffered.heartbeat_due and buffered.heartbeat_due <= now]
+                for buffered in due:
+                    buffered.heartbeat_due = now + buffered.heartbeat_interval
+
+            for buffered in due:
+                self._heartbeat(buffered.task)
+
+            # drops tasks that timed out while waiting
+            self._dispatch()
+
+    def complete(self, task, succeeded, result):
+        if not succeeded:
+            result = ActivityFailed(reason='Unhandled exception', details=result)
+        elif not isinstance(result, (ActivityCompleted, ActivityCanceled, ActivityFailed)):
+            result = ActivityCompleted(result=result)
+
+        self.backend.complete_activity_task(task, result)
+
+class DecisionWorker(Worker):
+    # handler is called with a DecisionTask, and returns the decisions to respond with
+
+    DEFAULT_CATEGORY = Defaults.DECISION_CATEGORY
+
+    def poll(self, category):
+        return self.backend.poll_decision_task(category=category, identity=self.identity)
+
+    def _picklable(self, task):
+        # handlers in the process pool get the process with its history read, and none of the
+        # backend's own context
+        process = copy.copy(task.process)
+        for name in ('input', 'tags', 'parent'):
+            setattr(process, name, getattr(task.process, name))
+        process.history = list(task.process.history)
+        return DecisionTask(process, context={'token': task.context['token']})
+
+    def complete(self, task, succeeded, decisions):
+        if not succeeded:
+            # leave the decision task to time out, so it's retried
+            logger.error('Decision handler failed:\n%s', decisions)
+            return
+
+        self.backend.complete_decision_task(task, decisions)
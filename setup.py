@@ -38,6 +38,11 @@ setup(
   ],
   packages=packages,
   namespace_packages=['pyworkflow'],
+  entry_points={
+    'console_scripts': [
+      'pyworkflow-amazonswf = pyworkflow.amazonswf.launcher:main',
+    ]
+  },
   test_suite='pyworkflow.amazonswf.test',
   license='MIT License',
   classifiers=[